@@ -0,0 +1,462 @@
+#! /usr/bin/env python3
+# bench
+# Benchmark a Monto broker and servers with synthetic sources.
+
+import bisect
+import collections
+import getopt
+import json
+import os
+import random
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+import montolib
+
+# Main program
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:fhn:o:p:r:s:w:z:',
+                                   ['duration=', 'full', 'help', 'sources=',
+                                    'output=', 'port=', 'rate=', 'servers=',
+                                    'wait=', 'size=', 'drive=', 'slow='])
+    except getopt.GetoptError as err:
+        error(err)
+        sys.exit(2)
+    params = {
+        'duration': 10.0,
+        'edits': True,
+        'sources': 10,
+        'port': 5500,
+        'rate': 10.0,
+        'servers': ['length', 'reverse', 'reflect'],
+        'wait': 5.0,
+        'size': 10000,
+        'seed': 1
+    }
+    output = None
+    for o, a in opts:
+        if o in ('-d', '--duration'):
+            params['duration'] = numarg(a, float, 'duration')
+        elif o in ('-f', '--full'):
+            params['edits'] = False
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-n', '--sources'):
+            params['sources'] = numarg(a, int, 'number of sources')
+        elif o in ('-o', '--output'):
+            output = a
+        elif o in ('-p', '--port'):
+            params['port'] = numarg(a, int, 'port')
+        elif o in ('-r', '--rate'):
+            params['rate'] = numarg(a, float, 'rate')
+        elif o in ('-s', '--servers'):
+            params['servers'] = a.split(',') if a else []
+        elif o in ('-w', '--wait'):
+            params['wait'] = numarg(a, float, 'wait')
+        elif o in ('-z', '--size'):
+            params['size'] = numarg(a, int, 'size')
+        elif o == '--drive':
+            drive(*json.loads(a))
+            return
+        elif o == '--slow':
+            numarg(a, float, 'delay')
+            slow_server(a)
+            return
+        else:
+            assert False, 'unhandled option'
+    results = bench(params)
+    if output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+def error(msg):
+    print('bench: {0!s}'.format(msg))
+    usage()
+
+
+def usage():
+    print('usage: bench [-d duration] [-f] [-n sources] [-o output] [-p port]')
+    print('             [-r rate] [-s servers] [-w wait] [-z size]')
+    print('  -d: seconds to publish versions for (default: 10)')
+    print('  -f: publish full versions instead of edits')
+    print('  -n: number of sources (default: 10)')
+    print('  -o: file to write the JSON results to (default: standard output)')
+    print('  -p: first of the eight ports to use (default: 5500)')
+    print('  -r: edits per second for each source (default: 10)')
+    print('  -s: comma-separated servers: length, reverse, reflect or '
+          'slow:delay')
+    print('  -w: seconds to wait for products at the end (default: 5)')
+    print('  -z: approximate size of each source in bytes (default: 10000)')
+
+
+def numarg(arg, type, what):
+    try:
+        return type(arg)
+    except ValueError:
+        error('{0} \'{1}\' is not a number'.format(what, arg))
+        sys.exit(2)
+
+# Benchmark
+
+# The benchmark runs a broker, the servers and a driver process (see drive)
+# in a temporary home directory whose .monto file gives them their own
+# ports, so it doesn't interfere with a running Monto, and has every
+# version traced (see Tracing in montolib). The driver writes its results
+# to a file in that directory. The memory of each process is sampled every
+# SAMPLE seconds while the driver runs. The result is the driver's results
+# with the parameters of the run, the peak resident memory and CPU time of
+# each process added.
+
+STARTUP = 1.0
+SAMPLE = 0.2
+
+
+def bench(params):
+    home = tempfile.mkdtemp(prefix='monto-bench')
+    write_config(home, params['port'])
+    env = dict(os.environ, HOME=home)
+    processes = collections.OrderedDict()
+    try:
+        processes['broker'] = start_process(script_command('broker'), env)
+        time.sleep(STARTUP)
+        for server in params['servers']:
+            processes[server] = start_process(server_command(server), env)
+        time.sleep(STARTUP)
+        results = os.path.join(home, 'results.json')
+        driver = start_process(script_command('bench', '--drive',
+                                              json.dumps([params, results])),
+                               env)
+        processes['driver'] = driver
+        resources = sample_usage(processes, driver)
+        with open(results) as file:
+            results = json.load(file)
+    finally:
+        for process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        shutil.rmtree(home)
+    results['parameters'] = params
+    results['processes'] = resources
+    return results
+
+
+def write_config(home, port):
+    names = ['from_sources', 'to_servers', 'from_servers', 'to_sinks',
+             'from_sinks', 'stats', 'tap', 'groups']
+    config = {
+        'connections': {
+            name: 'tcp://127.0.0.1:{0}'.format(port + i)
+            for i, name in enumerate(names)
+        },
+        'trace': {'sample': 1}
+    }
+    with open(os.path.join(home, '.monto'), 'w') as file:
+        json.dump(config, file)
+
+
+def start_process(command, env):
+    return subprocess.Popen(command, env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL)
+
+
+def script_command(name, *args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          name + '.py')
+    return [sys.executable, script] + list(args)
+
+
+def server_command(server):
+    if server.startswith('slow:'):
+        return script_command('bench', '--slow', server[5:])
+    else:
+        return script_command(server)
+
+
+def server_product(server):
+    if server.startswith('slow:'):
+        return 'slow' + server[5:]
+    else:
+        return server
+
+# Sample the peak resident memory and the CPU time of each process, including
+# its children, until the driver has finished.
+
+
+def sample_usage(processes, driver):
+    resources = {name: {'rss': 0, 'cpu': 0.0} for name in processes}
+    while True:
+        finished = driver.poll() is not None
+        for name, process in processes.items():
+            try:
+                p = psutil.Process(process.pid)
+                ps = [p] + p.children(recursive=True)
+                rss = sum(q.memory_info().rss for q in ps)
+                cpu = sum(sum(q.cpu_times()[:2]) for q in ps)
+            except psutil.NoSuchProcess:
+                continue
+            resources[name]['rss'] = max(resources[name]['rss'], rss)
+            resources[name]['cpu'] = cpu
+        if finished:
+            return resources
+        time.sleep(SAMPLE)
+
+# Driver
+
+# The driver publishes versions for params['sources'] synthetic sources,
+# each with about params['size'] bytes of text, for params['duration']
+# seconds. Each source is edited params['rate'] times a second like a user
+# typing: mostly inserting characters at a cursor, sometimes starting a new
+# line or deleting the previous character. Edits are published as edits
+# unless params['edits'] is False.
+
+# A sink in another thread records when each product arrives. Every
+# version is traced, and a product carries the trace of the version that
+# it was made from, so the 'publish' hop of its trace tells which version
+# of its source that was. Its latency is the time since that version was
+# published. The older versions that have no product with the same name
+# yet are counted as 'superseded' (they were coalesced or skipped somewhere
+# along the way) and products for versions older than one that already has
+# a product as 'extra'. Untraced products are counted as 'untraced' and
+# otherwise ignored. After publishing stops, the driver waits for up to
+# params['wait'] seconds for the outstanding products. Versions that don't
+# get a product of each expected name are counted as 'lost'. The results
+# are written to the file output as JSON.
+
+# Before it starts, the driver checks that the broker still accepts a
+# large version from an old client that sends single-frame JSON messages
+# on a REQ socket (see check_legacy). The result is 'legacy' in the
+# results.
+
+
+def drive(params, output):
+    random.seed(params['seed'])
+    expected = set(server_product(server) for server in params['servers'])
+    tracker = Tracker()
+    sink = threading.Thread(target=tracker.run, daemon=True)
+    sink.start()
+    time.sleep(STARTUP)
+    legacy = check_legacy()
+
+    source = montolib.MontoSource()
+    texts = {}
+    cursors = {}
+    for i in range(params['sources']):
+        name = '/bench/source{0}.txt'.format(i)
+        texts[name] = random_text(params['size'])
+        cursors[name] = random.randrange(len(texts[name]) + 1)
+        tracker.published(name)
+        source.publish_version(name, 'text', texts[name])
+    names = sorted(texts)
+
+    started = time.monotonic()
+    interval = 1 / (params['rate'] * len(names)) if names else 1
+    due = started
+    count = 0
+    while time.monotonic() - started < params['duration'] and names:
+        name = names[count % len(names)]
+        (text, cursor, edit) = random_edit(texts[name], cursors[name])
+        texts[name] = text
+        cursors[name] = cursor
+        tracker.published(name)
+        if params['edits']:
+            source.publish_edits(name, 'text', [edit])
+        else:
+            source.publish_version(name, 'text', text)
+        count += 1
+        due += interval
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    source.flush()
+    elapsed = time.monotonic() - started
+
+    tracker.wait(expected, params['wait'])
+    results = tracker.results(expected)
+    results['versions'] = {
+        'published': count + len(names),
+        'rate': count / elapsed
+    }
+    results['products']['rate'] = results['products']['received'] / elapsed
+    results['source'] = source.stats
+    results['legacy'] = legacy
+    source.close()
+    broker = montolib.request_stats()
+    if broker is not None:
+        del broker['sources']
+    results['broker'] = broker
+    with open(output, 'w') as file:
+        json.dump(results, file)
+
+
+# Send a version of more than ZERO_COPY bytes (so that the broker
+# receives it without copying) as a single JSON frame from a REQ socket.
+# Returns True if the broker acknowledged it within LEGACY_TIMEOUT
+# milliseconds.
+
+LEGACY_TIMEOUT = 2000
+
+
+def check_legacy():
+    name = '/bench/legacy.txt'
+    version = {
+        'source': name,
+        'language': 'text',
+        'contents': random_text(2 * montolib.ZERO_COPY)
+    }
+    context = montolib.zmq.Context()
+    socket = context.socket(montolib.zmq.REQ)
+    socket.setsockopt(montolib.zmq.LINGER, 0)
+    montolib.connect(socket, montolib.shard_address(name, 'from_sources'))
+    socket.send(json.dumps(version).encode())
+    acked = bool(socket.poll(LEGACY_TIMEOUT)) and \
+        socket.recv() == montolib.ACK
+    socket.close()
+    return acked
+
+
+def random_text(size):
+    words = []
+    length = 0
+    while length < size:
+        word = ''.join(random.choice(string.ascii_lowercase)
+                       for _ in range(random.randint(1, 8)))
+        words.append(word + ('\n' if random.random() < 0.1 else ' '))
+        length += len(words[-1])
+    return ''.join(words)
+
+
+def random_edit(text, cursor):
+    choice = random.random()
+    if choice < 0.1 and cursor > 0:
+        edit = {'begin': cursor - 1, 'end': cursor, 'text': ''}
+        cursor -= 1
+    else:
+        char = '\n' if choice < 0.15 else random.choice(string.ascii_lowercase)
+        edit = {'begin': cursor, 'end': cursor, 'text': char}
+        cursor += 1
+    text = text[:edit['begin']] + edit['text'] + text[edit['end']:]
+    return (text, cursor, edit)
+
+# A Tracker matches products to versions (see drive above).
+
+
+class Tracker:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.times = collections.defaultdict(list)
+        self.matched = collections.defaultdict(int)
+        self.latencies = collections.defaultdict(list)
+        self.counts = {'received': 0, 'superseded': 0, 'extra': 0,
+                       'untraced': 0}
+
+    # Called just before a version of source is published, so the 'publish'
+    # hop of its trace is no earlier than the time recorded here.
+
+    def published(self, source):
+        with self.lock:
+            self.times[source].append(time.time())
+
+    def run(self):
+        context = montolib.zmq.Context()
+        tosinks = context.socket(montolib.zmq.SUB)
+        montolib.connect_all(tosinks, 'to_sinks')
+        montolib.subscribe(tosinks, montolib.product_topic)
+        while True:
+            (_, frames) = montolib.recv_routed(tosinks)
+            now = time.time()
+            header = montolib.decode_header(frames)
+            self.received(header, now)
+
+    def received(self, header, now):
+        source = header['source']
+        product = header['product']
+        with self.lock:
+            if source not in self.times:
+                return
+            self.counts['received'] += 1
+            if 'trace' not in header:
+                self.counts['untraced'] += 1
+                return
+            published = header['trace']['hops'][0][1]
+            count = bisect.bisect_right(self.times[source], published)
+            key = (source, product)
+            if count > self.matched[key]:
+                self.latencies[product].append(now - published)
+                self.counts['superseded'] += count - self.matched[key] - 1
+                self.matched[key] = count
+            else:
+                self.counts['extra'] += 1
+            self.lock.notify_all()
+
+    def outstanding(self, expected):
+        return sum(len(times) - self.matched[(source, product)]
+                   for source, times in self.times.items()
+                   for product in expected)
+
+    def wait(self, expected, timeout):
+        with self.lock:
+            self.lock.wait_for(lambda: self.outstanding(expected) == 0,
+                               timeout)
+
+    def results(self, expected):
+        with self.lock:
+            products = dict(self.counts)
+            products['lost'] = self.outstanding(expected)
+            latency = {product: percentiles(times)
+                       for product, times in self.latencies.items()}
+            latency['all'] = percentiles([t for times
+                                          in self.latencies.values()
+                                          for t in times])
+            return {'products': products, 'latency': latency}
+
+# Summarise times in seconds as milliseconds.
+
+
+def percentiles(times):
+    times = sorted(times)
+    summary = {'count': len(times)}
+    if times:
+        for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            summary[name] = times[min(len(times) - 1,
+                                      int(q * len(times)))] * 1000
+        summary['max'] = times[-1] * 1000
+        summary['mean'] = sum(times) / len(times) * 1000
+    return summary
+
+# Slow server
+
+# A server that takes delay seconds to produce a product for each version.
+# delay is a string so that the product name is the same as the one that
+# server_product gives.
+
+
+def slow_server(delay):
+    def slow_product(version):
+        time.sleep(float(delay))
+        product = {
+            'source': version['source'],
+            'product': 'slow' + delay,
+            'language': 'number',
+            'contents': str(len(version['contents']))
+        }
+        return ([product], True)
+    montolib.server(slow_product)
+
+# Startup
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,50 @@
 #! /usr/bin/env python3
 # A broker between Monto sources, servers and sinks
 
+import getopt
+import sys
+
 import montolib
 
-montolib.broker()
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hs:t',
+                                   ['help', 'shard=', 'threads'])
+    except getopt.GetoptError as err:
+        error(err)
+        sys.exit(1)
+    shard = 0
+    threads = montolib.THREADS
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-s', '--shard'):
+            try:
+                shard = int(a)
+            except ValueError:
+                error('shard \'{0}\' is not a number'.format(a))
+                sys.exit(2)
+        elif o in ('-t', '--threads'):
+            threads = True
+        else:
+            assert False, 'unhandled option'
+    if args:
+        error('unexpected arguments')
+        sys.exit(2)
+    montolib.broker(threads, shard)
+
+
+def error(msg):
+    print('broker: {0!s}'.format(msg))
+    usage()
+
+
+def usage():
+    print('usage: broker [-s shard] [-t]')
+
+# Startup
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+# latency
+# Receive traced products from Monto and print how long they spent between
+# each pair of hops (see Tracing in montolib).
+
+import getopt
+import sys
+
+import montolib
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:p:v',
+                                   ['count=', 'help', 'products=', 'verbose'])
+    except getopt.GetoptError as err:
+        error(err)
+        sys.exit(1)
+    count = None
+    products = None
+    verbose = False
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-n', '--count'):
+            try:
+                count = int(a)
+            except ValueError:
+                error('count \'{0}\' is not a number'.format(a))
+                sys.exit(2)
+        elif o in ('-p', '--products'):
+            products = a.split(',')
+        elif o in ('-v', '--verbose'):
+            verbose = True
+        else:
+            assert False, 'unhandled option'
+    if args:
+        error('unexpected arguments')
+        sys.exit(2)
+    latency(count, products, verbose)
+
+
+def error(msg):
+    print('latency: {0!s}'.format(msg))
+    usage()
+
+
+def usage():
+    print('usage: latency [-n count] [-p products] [-v]')
+
+# Latency
+
+# Collect count traced products (or until interrupted) and print the
+# latency between each pair of consecutive hops and from the first hop to
+# the last. Products without a trace and ones whose trace has been seen
+# before (e.g., because the broker replayed them) are ignored. If verbose
+# is True, the hops of each product are printed as it arrives.
+
+
+def latency(count, products, verbose):
+    breakdown = Breakdown()
+    seen = set()
+
+    def collect(product):
+        trace = product.get('trace')
+        if trace is None:
+            return True
+        key = (trace['id'], product['product'])
+        if key in seen:
+            return True
+        seen.add(key)
+        breakdown.add(trace['hops'])
+        if verbose:
+            print('{0} {1} {2}'.format(trace['id'], product['product'],
+                                       product['source']))
+            for (name, ms) in intervals(trace['hops']):
+                print('  {0:<20} {1:9.3f}ms'.format(name, ms))
+        return count is None or breakdown.count < count
+
+    try:
+        montolib.sink(collect, products=products)
+    except KeyboardInterrupt:
+        pass
+    breakdown.print()
+
+
+def intervals(hops):
+    return [('{0}-{1}'.format(a[0], b[0]), (b[1] - a[1]) * 1000)
+            for (a, b) in zip(hops, hops[1:])]
+
+# A Breakdown keeps the latencies of each interval between hops, in the
+# order that they were first seen, and the total from first to last hop.
+
+
+class Breakdown:
+    def __init__(self):
+        self.count = 0
+        self.latencies = {}
+
+    def add(self, hops):
+        self.count += 1
+        for (name, ms) in intervals(hops):
+            self.latencies.setdefault(name, []).append(ms)
+        total = (hops[-1][1] - hops[0][1]) * 1000
+        self.latencies.setdefault('total', []).append(total)
+
+    def print(self):
+        print('latency: {0} traced products'.format(self.count))
+        if not self.count:
+            return
+        print('{0:<20} {1:>7} {2:>9} {3:>9} {4:>9} {5:>9}'.format(
+            'hops', 'count', 'mean', 'p50', 'p90', 'max'))
+        total = self.latencies.pop('total')
+        for (name, values) in list(self.latencies.items()) + \
+                [('total', total)]:
+            values.sort()
+            print('{0:<20} {1:>7} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f}'
+                  .format(name, len(values), sum(values) / len(values),
+                          percentile(values, 0.5), percentile(values, 0.9),
+                          values[-1]))
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+# Startup
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 # Monto command
 
 import getopt
+import json
 import multiprocessing
 import pathlib
 import os
@@ -10,6 +11,7 @@ import signal
 import subprocess
 import sys
 import tempfile
+import time
 import montolib
 
 # Main program
@@ -17,15 +19,22 @@ import montolib
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help'])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hjs',
+                                       ['help', 'json', 'stats'])
     except getopt.GetoptError as err:
         montolib.error(err)
         usage()
         sys.exit(2)
+    stats = False
+    asjson = False
     for o, a in opts:
         if o in ('-h', '--help'):
             usage()
             sys.exit()
+        elif o in ('-j', '--json'):
+            asjson = True
+        elif o in ('-s', '--stats'):
+            stats = True
         else:
             assert False, 'unhandled option'
     numargs = len(args)
@@ -41,7 +50,7 @@ def main():
         if command == 'start':
             start(config, set())
         elif command == 'status':
-            status(config)
+            status(config, stats, asjson)
         elif command == 'stop':
             stop(config)
         else:
@@ -57,7 +66,11 @@ def main():
 
 def usage():
     print('usage: monto [-h] [command]')
-    print('  commands: restart, start [set...] (default), status, stop')
+    print('  commands: restart, start [set...] (default), status [-s] [-j], '
+          'stop')
+    print('  status options: -s/--stats: show resource usage and broker '
+          'statistics')
+    print('                  -j/--json: print the status as JSON')
 
 # Management of lock file that contains PIDs of broker and programs
 
@@ -148,19 +161,51 @@ def should_run(program, sets):
 
 # Status command
 
-
-def status(config):
-    if monto_is_running():
+# With stats, the CPU usage (in percent, measured over CPU_INTERVAL seconds)
+# and resident memory of each program and the statistics of the broker are
+# shown as well. With asjson, the status is printed as a JSON object.
+
+CPU_INTERVAL = 0.5
+
+
+def status(config, stats=False, asjson=False):
+    running = monto_is_running()
+    pids = get_pids() if running else []
+    programs = [{'pid': pid, 'command': process_desc(pid)} for pid in pids]
+    brokers = []
+    if stats:
+        add_usage(programs)
+        brokers = [montolib.request_stats(address=shard['stats'])
+                   for shard in montolib.SHARDS]
+    if asjson:
+        print(json.dumps({
+            'running': running,
+            'programs': programs,
+            'broker': brokers[0] if brokers else None,
+            'shards': brokers
+        }, indent=2))
+        return
+    if running:
         print('monto is running')
-        pids = get_pids()
         if len(pids) == 0:
             print('  no programs')
         else:
             print('  programs:')
-            for pid in pids:
-                print('    {0}'.format(process_desc(pid)))
+            for program in programs:
+                if 'rss' in program:
+                    print('    {0:5.1f}% {1:8.1f}M  {2}'.format(
+                        program['cpu'], program['rss'] / 1024 / 1024,
+                        program['command']))
+                else:
+                    print('    {0}'.format(program['command']))
     else:
         print('monto is not running')
+    for shard, broker in enumerate(brokers):
+        name = 'broker' if len(brokers) == 1 else 'broker {0}'.format(shard)
+        if broker is None:
+            print('{0} statistics are not available'.format(name))
+        else:
+            print_broker_stats(broker, name)
 
 
 def process_desc(pid):
@@ -172,6 +217,95 @@ def process_desc(pid):
     except psutil.NoSuchProcess:
         return 'no process ({0!s})'.format(pid)
 
+# Add the CPU usage and resident memory of each program and its children
+# (e.g., the workers of a server) to its description.
+
+
+def add_usage(programs):
+    processes = {}
+    for program in programs:
+        try:
+            p = psutil.Process(program['pid'])
+            processes[program['pid']] = [p] + p.children(recursive=True)
+            for q in processes[program['pid']]:
+                q.cpu_percent(None)
+        except psutil.NoSuchProcess:
+            pass
+    time.sleep(CPU_INTERVAL)
+    for program in programs:
+        cpu = 0.0
+        rss = 0
+        for q in processes.get(program['pid'], []):
+            try:
+                cpu += q.cpu_percent(None)
+                rss += q.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        program['cpu'] = cpu
+        program['rss'] = rss
+
+# Print the busiest sources and products and a summary of the rest of the
+# broker statistics.
+
+TOP = 10
+
+
+def print_broker_stats(broker, title='broker'):
+    print('{0} (up {1:.0f}s):'.format(title, broker['uptime']))
+    print('  documents: {0}, queued versions: {1}'.format(
+        broker['documents'], broker['queued']))
+    for name in ('versions_in', 'versions_out', 'products_in', 'products_out'):
+        print('  {0:13} {1}'.format(name + ':', meter_desc(broker[name])))
+    scheduler = broker['scheduler']
+    print('  coalesced: {0}, duplicates: {1}, throttled: {2}, held: {3}'
+          .format(scheduler['coalesced'], scheduler['duplicates'],
+                  scheduler.get('throttled', 0),
+                  histogram_desc(broker['held'])))
+    cache = broker['cache']
+    print('  product cache: {0} entries, {1} bytes, {2} evictions'.format(
+        cache['entries'], cache['bytes'], cache['evictions']))
+    sinks = broker.get('sinks')
+    if sinks is not None:
+        print('  sinks: {0} waiting, {1} conflated, {2} dropped'.format(
+            sinks['waiting'], sinks['conflated'], sinks['dropped']))
+    for kind in ('versions', 'products'):
+        forwarded = broker.get('forwarded_' + kind)
+        if forwarded is not None:
+            print('  forwarded {0}: {1} sent, {2} dropped{3}'.format(
+                kind, forwarded['sent'], forwarded['dropped'],
+                ', {0} resyncs'.format(forwarded['resyncs'])
+                if 'resyncs' in forwarded else ''))
+    groups = broker.get('groups')
+    if groups is not None:
+        print('  server groups: {0} joined, {1} left, {2} expired, '
+              '{3} dispatched, {4} reassigned'.format(
+                  groups['joined'], groups['left'], groups['expired'],
+                  groups['dispatched'], groups['reassigned']))
+        for name, group in sorted(groups['groups'].items()):
+            print('    {0}: {1} replicas, {2} in flight'.format(
+                name, group['replicas'], group['in_flight']))
+    print('  loop phases:')
+    for name, histogram in sorted(broker['phases'].items()):
+        print('    {0:8} {1}'.format(name + ':', histogram_desc(histogram)))
+    for kind in ('sources', 'products'):
+        meters = sorted(broker[kind].items(),
+                        key=lambda item: (item[1]['rate'], item[1]['count']),
+                        reverse=True)
+        print('  {0} (top {1} of {2}):'.format(kind, min(TOP, len(meters)),
+                                               len(meters)))
+        for name, meter in meters[:TOP]:
+            print('    {0}: {1}'.format(name, meter_desc(meter)))
+
+
+def meter_desc(meter):
+    return '{0} ({1} bytes), {2:.1f}/s ({3:.0f} bytes/s)'.format(
+        meter['count'], meter['bytes'], meter['rate'], meter['byte_rate'])
+
+
+def histogram_desc(histogram):
+    return '{0} times, mean {1:.3f}ms, max {2:.3f}ms'.format(
+        histogram['count'], histogram['mean'], histogram['max'])
+
 # Stop command
 
 
@@ -3,9 +3,27 @@
 # Library functions to help write Monto sources, servers and sinks
 # that communicate via a Monto broker.
 
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import cProfile
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import mmap
 import os
+import random
+import re
+import socket
 import sys
+import tempfile
+import threading
+import time
+import zlib
 
 try:
     import SublimeMonto.pathlib as pathlib
@@ -17,147 +35,3590 @@ try:
 except ImportError:
     import zmq
 
+try:
+    import zmq.asyncio as zmq_asyncio
+except ImportError:
+    zmq_asyncio = None
+
 # Error reporting
 
 
-def error(msg):
-    print('monto: {0!s}'.format(msg))
+def error(msg):
+    print('monto: {0!s}'.format(msg))
+
+# Default addresses, can be overridden in .monto
+FROMSOURCES_DEFAULT = b'tcp://127.0.0.1:5000'
+TOSERVERS_DEFAULT = b'tcp://127.0.0.1:5001'
+FROMSERVERS_DEFAULT = b'tcp://127.0.0.1:5002'
+TOSINKS_DEFAULT = b'tcp://127.0.0.1:5003'
+FROMSINKS_DEFAULT = b'tcp://127.0.0.1:5004'
+STATS_DEFAULT = b'tcp://127.0.0.1:5005'
+TAP_DEFAULT = b'tcp://127.0.0.1:5006'
+GROUPS_DEFAULT = b'tcp://127.0.0.1:5007'
+
+# Configuration file reading
+
+
+def monto_config_file_path():
+    return pathlib.Path(os.path.expanduser('~/.monto'))
+
+
+def monto_read_config():
+    with monto_config_file_path().open('r') as file:
+        try:
+            return json.load(file)
+        except ValueError as err:
+            error('can\'t parse config file as JSON: {0!s}'.format(err))
+            sys.exit(3)
+
+# Global configuration
+monto_config = monto_read_config()
+
+# Setup communication addresses
+
+
+def monto_connection_or_default(name, default):
+    if 'connections' in monto_config:
+        connections = monto_config['connections']
+        return connections.get(name, default)
+    else:
+        return default
+
+FROMSOURCES = monto_connection_or_default('from_sources', FROMSOURCES_DEFAULT)
+TOSERVERS = monto_connection_or_default('to_servers', TOSERVERS_DEFAULT)
+FROMSERVERS = monto_connection_or_default('from_servers', FROMSERVERS_DEFAULT)
+TOSINKS = monto_connection_or_default('to_sinks', TOSINKS_DEFAULT)
+FROMSINKS = monto_connection_or_default('from_sinks', FROMSINKS_DEFAULT)
+STATS = monto_connection_or_default('stats', STATS_DEFAULT)
+TAP = monto_connection_or_default('tap', TAP_DEFAULT)
+GROUPS = monto_connection_or_default('groups', GROUPS_DEFAULT)
+
+# Local connections
+
+# Processes on the same host as the broker can talk to it through Unix
+# domain sockets, which are cheaper than TCP. The broker binds an ipc://
+# endpoint, named after the port, next to each TCP endpoint on the local
+# host, and connect uses it instead of the TCP address if a broker is
+# listening on it. Processes therefore still use TCP to talk to brokers
+# that don't bind ipc:// endpoints. Setting 'ipc' to false in the
+# 'connections' section turns this off.
+
+IPC = monto_connection_or_default('ipc', os.name == 'posix')
+
+
+def ipc_address(address):
+    if isinstance(address, bytes):
+        address = address.decode()
+    match = re.match(r'tcp://(127\.0\.0\.1|localhost|\*):(\d+)$', address)
+    if not IPC or match is None:
+        return None
+    return 'ipc://' + os.path.join(tempfile.gettempdir(),
+                                   'monto-{0}'.format(match.group(2)))
+
+
+def bind(socket, address):
+    socket.bind(address)
+    local = ipc_address(address)
+    if local is not None:
+        try:
+            socket.bind(local)
+        except zmq.ZMQError as err:
+            error('can\'t bind {0}: {1!s}'.format(local, err))
+
+
+def connect(socket, address):
+    local = ipc_address(address)
+    if local is not None and is_listening(local[len('ipc://'):]):
+        address = local
+    socket.connect(address)
+
+
+def is_listening(path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+# Shards
+
+# A session can be spread over several brokers, called shards, each of
+# which handles the sources whose names hash to it and keeps its own
+# documents, coalescing and product cache. The 'shards' setting in the
+# 'connections' section of .monto is a list with an object for each shard
+# that has all of the addresses of the 'connections' section
+# ('from_sources', 'to_servers', 'from_servers', 'to_sinks', 'from_sinks',
+# 'stats', 'tap' and 'groups'). Sources send each version to the shard of
+# its source and servers send each product to the shard of the product's
+# source (see Shards), while servers and sinks subscribe to all of the
+# shards. Without the setting there is one shard with the addresses above.
+
+SHARDS = monto_connection_or_default('shards', None) or [{
+    'from_sources': FROMSOURCES,
+    'to_servers': TOSERVERS,
+    'from_servers': FROMSERVERS,
+    'to_sinks': TOSINKS,
+    'from_sinks': FROMSINKS,
+    'stats': STATS,
+    'tap': TAP,
+    'groups': GROUPS
+}]
+
+
+def shard_of(source, count):
+    return zlib.crc32(source.encode()) % count if count > 1 else 0
+
+
+def shard_address(source, name, shards=SHARDS):
+    return shards[shard_of(source, len(shards))][name]
+
+
+def connect_all(socket, name, shards=SHARDS):
+    for shard in shards:
+        connect(socket, shard[name])
+
+
+def from_sources(shards=SHARDS):
+    return [shard['from_sources'] for shard in shards]
+
+
+def from_servers(shards=SHARDS):
+    return [shard['from_servers'] for shard in shards]
+
+# Broker settings, can be overridden in the 'broker' section of .monto.
+# Times are in milliseconds.
+
+
+def monto_setting_or_default(section, name, default):
+    return monto_config.get(section, {}).get(name, default)
+
+DEBOUNCE = monto_setting_or_default('broker', 'debounce', 100)
+MAX_HOLD = monto_setting_or_default('broker', 'max_hold', 500)
+CACHE_ENTRIES = monto_setting_or_default('broker', 'cache_entries', 1024)
+CACHE_SIZE = monto_setting_or_default('broker', 'cache_size', 64 * 1024 * 1024)
+CACHE_EVICTION = monto_setting_or_default('broker', 'eviction', 'used')
+SINK_HWM = monto_setting_or_default('broker', 'sink_hwm', 1000)
+SINK_TIMEOUT = monto_setting_or_default('broker', 'sink_timeout', 1000)
+THREADS = monto_setting_or_default('broker', 'threads', False)
+FORWARD = monto_setting_or_default('broker', 'forward', [])
+HEARTBEAT = monto_setting_or_default('broker', 'heartbeat', 1000)
+LIVENESS = monto_setting_or_default('broker', 'liveness', 3)
+BACKGROUND_RATE = monto_setting_or_default('broker', 'background_rate', 20)
+INTERACTIVE_WINDOW = monto_setting_or_default('broker', 'interactive_window',
+                                              1000)
+
+# The fraction of versions that sources trace (see Tracing below), can be
+# overridden by the 'sample' setting in the 'trace' section of .monto.
+TRACE = monto_setting_or_default('trace', 'sample', 0)
+
+# Routing topics
+
+# The broker publishes every version and product as a multi-frame message
+# whose first frame is a routing topic. A topic is a sequence of fields,
+# each terminated by a NUL byte: the kind of the message ('version',
+# 'delta' or 'product') followed by the fields that receivers are most
+# likely to select on. For versions and deltas these are the language and
+# then the source, for products the product name and then the source.
+# ZeroMQ subscriptions are prefix matches on the first frame, so a server
+# that subscribes to version_topic('haskell') has every non-Haskell
+# version dropped by the ZeroMQ library without it ever being decoded.
+
+
+def make_topic(*fields):
+    return b''.join(field.encode() + b'\0' for field in fields)
+
+
+def kind_topic(kind, first=None, second=None):
+    fields = [kind]
+    if first is not None:
+        fields.append(first)
+        if second is not None:
+            fields.append(second)
+    return make_topic(*fields)
+
+
+def version_topic(language=None, source=None):
+    return kind_topic('version', language, source)
+
+
+def delta_topic(language=None, source=None):
+    return kind_topic('delta', language, source)
+
+
+def source_topic():
+    return kind_topic('source')
+
+
+def product_topic(product=None, source=None):
+    return kind_topic('product', product, source)
+
+# Versions for a member of a server group are published under the topic
+# of the member, followed by the usual version or delta topic, so only
+# that member receives them. The broker welcomes a new member with a
+# message on its welcome topic.
+
+
+def replica_topic(replica):
+    return make_topic('replica', replica)
+
+
+WELCOME_TOPIC = make_topic('welcome')
+
+# Messages from brokers that don't send topics (such as the C broker)
+# consist of a single JSON frame, so they always start with this prefix.
+# Receivers subscribe to it as well so that they still work with such
+# brokers, falling back to filtering in Python.
+LEGACY_TOPIC = b'{'
+
+# Subscribe socket to the topics built by topic from each of the given
+# values. values can be None (subscribe to all messages of that kind), a
+# single value or a list of values. If replica is given, the topics are
+# those that the broker sends to that member of a server group (see
+# replica_topic), which never come from brokers without topics.
+
+
+def subscribe(socket, topic, values=None, replica=b''):
+    if values is None:
+        prefixes = [topic()]
+    elif isinstance(values, str):
+        prefixes = [topic(values)]
+    else:
+        prefixes = [topic(value) for value in values]
+    if not replica:
+        prefixes.append(LEGACY_TOPIC)
+    for prefix in prefixes:
+        socket.setsockopt(zmq.SUBSCRIBE, replica + prefix)
+
+# Receive a possibly routed message. Returns a pair of the topic and the
+# list of message frames. The topic is None if the message came without
+# one, in which case the receiver has to do its own filtering.
+
+
+def recv_routed(socket):
+    return split_routed(recv_frames(socket))
+
+
+def recv_routed_noblock(socket):
+    return split_routed(recv_frames(socket, zmq.NOBLOCK))
+
+# Receive a message without copying its large frames (normally contents)
+# out of ZeroMQ's buffers. Frames of at least ZERO_COPY bytes are returned
+# as memoryviews of those buffers and smaller ones as bytes. Messages are
+# sent with copy=False for the same reason: ZeroMQ then only copies the
+# small frames.
+
+ZERO_COPY = 65536
+
+
+def recv_frames(socket, flags=0):
+    return frame_values(socket.recv_multipart(flags, copy=False))
+
+
+def frame_values(frames):
+    return [frame.buffer if len(frame) >= ZERO_COPY else frame.bytes
+            for frame in frames]
+
+
+def split_routed(frames):
+    if len(frames) == 1:
+        return (None, frames)
+    else:
+        return (frames[0], frames[1:])
+
+# Return True if value passes filter, which has the same form as the values
+# argument of subscribe.
+
+
+def matches(filter, value):
+    if filter is None:
+        return True
+    elif isinstance(filter, str):
+        return filter == value
+    else:
+        return value in filter
+
+# Message encoding
+
+# Versions and products are sent as two frames: a small JSON header that
+# contains every field of the message except 'contents', and the contents
+# themselves as raw UTF-8 bytes. This means that the broker and anyone
+# else who only needs to route a message can do so by decoding the header,
+# no matter how big the contents are. Version headers also carry a 'hash'
+# of the contents. If the contents of a product are not a string, they are
+# sent as JSON and the header has an 'encoding' field of 'json'. Tables of
+# integers, such as tokens, can be sent in a compact binary form instead
+# (see Columnar products).
+
+# The older format of a single frame that contains the whole message as
+# JSON is still accepted wherever messages are received. It is recognised
+# by being a single frame whose header has a 'contents' field. Headers on
+# their own are used for edits and selection changes (see Documents below).
+
+# Several products can be sent in one message by concatenating their
+# header and contents frames.
+
+# Contents can be given as bytes-like objects, such as a memoryview of a
+# received frame or an mmap of a file, as well as strings. They are sent as
+# they are, so they must be UTF-8.
+
+BYTES_LIKE = (bytes, bytearray, memoryview, mmap.mmap)
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def contents_data(contents):
+    return contents.encode() if isinstance(contents, str) else contents
+
+
+def contents_text(contents):
+    return contents if isinstance(contents, str) else frame_text(contents)
+
+
+def frame_text(frame):
+    return str(frame, 'utf-8')
+
+
+def is_legacy(frames, header):
+    return len(frames) == 1 and 'contents' in header
+
+
+def encode_header(header):
+    return json.dumps(header).encode()
+
+
+def decode_header(frames):
+    return json.loads(frame_text(frames[0]))
+
+
+def encode_version(version):
+    header = dict(version)
+    data = contents_data(header.pop('contents'))
+    if 'hash' not in header:
+        header['hash'] = content_hash(data)
+    return [encode_header(header), data]
+
+# If data is True, the contents are left as the bytes-like frame that they
+# came in instead of being decoded.
+
+
+def decode_version(frames, data=False):
+    version = decode_header(frames)
+    if len(frames) > 1:
+        version['contents'] = frames[1] if data else frame_text(frames[1])
+    return version
+
+
+def encode_product(product):
+    header = dict(product)
+    contents = header.pop('contents')
+    if isinstance(contents, str):
+        data = contents.encode()
+    elif isinstance(contents, BYTES_LIKE):
+        data = contents
+    elif isinstance(contents, Columns):
+        header.update(contents.header())
+        data = contents.data
+    else:
+        header['encoding'] = 'json'
+        data = json.dumps(contents).encode()
+    return [encode_header(header), data]
+
+
+def decode_product(frames):
+    product = decode_header(frames)
+    if len(frames) > 1:
+        encoding = product.pop('encoding', None)
+        if encoding == 'columns':
+            product['contents'] = Columns.decode(product, frames[1])
+        elif encoding == 'json':
+            product['contents'] = json.loads(frame_text(frames[1]))
+        else:
+            product['contents'] = frame_text(frames[1])
+    return product
+
+
+def encode_products(products):
+    return [frame for product in products for frame in encode_product(product)]
+
+# Encode a version or product (header and contents frames) as a single
+# JSON frame with the contents in its 'contents' field, the format of
+# messages from REQ sockets. Tables are sent as JSON.
+
+
+def legacy_frame(frames):
+    message = decode_product(frames)
+    if isinstance(message.get('contents'), Columns):
+        message['contents'] = message['contents'].to_json()
+    return encode_header(message)
+
+# Split a message that contains products into a list of the frames of each
+# product, converting from the single-frame format if necessary.
+
+
+def split_products(frames):
+    if len(frames) == 1:
+        return [encode_product(decode_header(frames))]
+    else:
+        return [frames[i:i + 2] for i in range(0, len(frames), 2)]
+
+# Columnar products
+
+# Products such as tokens are tables with many rows of a few integers each.
+# As JSON lists of objects they are slow to build, encode and decode, so
+# they can be sent as Columns instead: the header describes the table and
+# the contents are its columns, one after the other, each as an array of
+# little-endian 32-bit signed integers. The header has an 'encoding' field
+# of 'columns' and the following fields:
+
+# 'columns': the names of the columns,
+# 'rows': the number of rows,
+# 'symbols': for each column of strings, the list of its distinct strings,
+# with the column holding indexes into the list,
+# 'relative': the names of the columns that hold the difference from the
+# value in the row before rather than the value itself (e.g., the offsets
+# of tokens, so that an edit only changes the rows around it), and
+# 'table': an identifier of the table.
+
+# A product can also be a splice that replaces some of the rows of an
+# earlier table of the same source and product name. Its header then has a
+# 'splice' field with the 'base' table identifier and the 'begin' and 'end'
+# of the rows of that table that are replaced by the rows of the splice,
+# and its 'symbols' are those of the whole new table. A server that sends
+# splices should send the whole table now and then (see TableSplicer), since
+# a sink that misses a splice can only catch up from a whole table.
+
+# A Columns is a table, either built by a ColumnsBuilder or decoded from a
+# product. Decoding doesn't copy the contents: the columns are read from
+# the frame in which they arrived.
+
+COLUMN_TYPE = 'i'
+COLUMN_SIZE = 4
+
+
+class Columns:
+    def __init__(self, columns, rows, data, symbols=None, relative=(),
+                 table=None, splice=None):
+        self.columns = list(columns)
+        self.rows = rows
+        self.data = data
+        self.symbols = symbols or {}
+        self.relative = list(relative)
+        self.table = table or os.urandom(8).hex()
+        self.splice = splice
+
+    def __len__(self):
+        return self.rows
+
+    def header(self):
+        header = {
+            'encoding': 'columns',
+            'columns': self.columns,
+            'rows': self.rows,
+            'table': self.table
+        }
+        if self.symbols:
+            header['symbols'] = self.symbols
+        if self.relative:
+            header['relative'] = self.relative
+        if self.splice is not None:
+            header['splice'] = self.splice
+        return header
+
+    # Make a Columns from the fields of a product header (which are removed
+    # from it) and the contents frame.
+
+    @classmethod
+    def decode(cls, header, data):
+        return cls(header.pop('columns'), header.pop('rows'), data,
+                   header.pop('symbols', None), header.pop('relative', ()),
+                   header.pop('table', None), header.pop('splice', None))
+
+    # Return the values of a column as stored, as a sequence of integers
+    # that is a view of the contents where possible.
+
+    def stored(self, name):
+        i = self.columns.index(name)
+        size = self.rows * COLUMN_SIZE
+        view = memoryview(self.data)[i * size:(i + 1) * size]
+        if sys.byteorder == 'little':
+            return view.cast(COLUMN_TYPE)
+        values = array.array(COLUMN_TYPE, view)
+        values.byteswap()
+        return values
+
+    # Return the values of a column, adding up the differences of relative
+    # columns.
+
+    def column(self, name):
+        values = self.stored(name)
+        if name in self.relative:
+            return array.array(COLUMN_TYPE, itertools.accumulate(values))
+        return values
+
+    # Return the values of a column with the strings of a column of
+    # symbols.
+
+    def values(self, name):
+        values = self.column(name)
+        if name in self.symbols:
+            return [self.symbols[name][value] for value in values]
+        return values
+
+    # Return the rows as dicts, which is the form of a table as JSON (e.g.,
+    # the tokens of products.md).
+
+    def to_json(self):
+        columns = [self.values(name) for name in self.columns]
+        return [dict(zip(self.columns, row)) for row in zip(*columns)]
+
+    # Return a splice that turns previous into this table, replacing the
+    # rows between the longest unchanged start and end of both. Returns the
+    # table itself if it can't be a splice of previous (different columns,
+    # symbols that don't extend those of previous, or previous is a
+    # splice), or if the splice would not be smaller.
+
+    def splice_of(self, previous):
+        if previous is None or previous.splice is not None or \
+                previous.columns != self.columns or \
+                previous.relative != self.relative or \
+                any(self.symbols.get(name, [])[:len(strings)] != strings
+                    for (name, strings) in previous.symbols.items()):
+            return self
+        old = column_views(previous)
+        new = column_views(self)
+        begin = min(common_prefix(a, b) for (a, b) in zip(old, new))
+        limit = min(previous.rows, self.rows) - begin
+        end = min(common_suffix(a, b, limit) for (a, b) in zip(old, new))
+        rows = self.rows - begin - end
+        if rows >= self.rows:
+            return self
+        data = b''.join(column[begin * COLUMN_SIZE:
+                               (self.rows - end) * COLUMN_SIZE]
+                        for column in new)
+        splice = {
+            'base': previous.table,
+            'begin': begin,
+            'end': previous.rows - end
+        }
+        return Columns(self.columns, rows, data, self.symbols, self.relative,
+                       self.table, splice)
+
+
+def is_splice(contents):
+    return isinstance(contents, Columns) and contents.splice is not None
+
+
+def column_views(columns):
+    size = columns.rows * COLUMN_SIZE
+    view = memoryview(columns.data)
+    return [bytes(view[i * size:(i + 1) * size])
+            for i in range(len(columns.columns))]
+
+# Return the number of rows at the start (or, for common_suffix, at the
+# end, at most limit) that two columns (as bytes) have in common, by
+# halving the range in which they start to differ.
+
+
+def common_prefix(a, b):
+    (low, high) = (0, min(len(a), len(b)) // COLUMN_SIZE)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle * COLUMN_SIZE] == b[:middle * COLUMN_SIZE]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_suffix(a, b, limit):
+    (low, high) = (0, limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle * COLUMN_SIZE:] == \
+                b[len(b) - middle * COLUMN_SIZE:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+# Apply the splice in frames (header and contents) to the frames of its
+# base table. Returns the frames of the whole new table, or None if base
+# is missing or isn't the table that the splice replaces rows of.
+
+
+def apply_splice(base, frames):
+    header = decode_header(frames)
+    splice = header.pop('splice')
+    if base is None:
+        return None
+    old = decode_header(base)
+    if old.get('table') != splice['base'] or \
+            old['columns'] != header['columns'] or 'splice' in old:
+        return None
+    (begin, end) = (splice['begin'], splice['end'])
+    size = old['rows'] * COLUMN_SIZE
+    added = header['rows'] * COLUMN_SIZE
+    (old_data, data) = (memoryview(base[1]), memoryview(frames[1]))
+    parts = []
+    for i in range(len(header['columns'])):
+        column = old_data[i * size:(i + 1) * size]
+        parts.append(column[:begin * COLUMN_SIZE])
+        parts.append(data[i * added:(i + 1) * added])
+        parts.append(column[end * COLUMN_SIZE:])
+    header['rows'] = old['rows'] - (end - begin) + header['rows']
+    return [encode_header(header), b''.join(parts)]
+
+# A ColumnsBuilder makes a Columns one row at a time. symbols are the
+# names of the columns that hold strings and relative those that are sent
+# as differences (see above). If base is given, the strings of symbol
+# columns are numbered as in base, so the new table can be a splice of it.
+
+
+class ColumnsBuilder:
+    def __init__(self, columns, symbols=(), relative=(), base=None):
+        self.columns = list(columns)
+        self.relative = [name for name in self.columns if name in relative]
+        self.arrays = [array.array(COLUMN_TYPE) for _ in self.columns]
+        self.symbols = {}
+        self.indexes = {}
+        for name in symbols:
+            strings = list(base.symbols.get(name, [])) if base else []
+            self.symbols[name] = strings
+            self.indexes[name] = {s: i for (i, s) in enumerate(strings)}
+        self.last = [0] * len(self.columns)
+        self.kinds = [(name in self.indexes, name in self.relative)
+                      for name in self.columns]
+
+    def add(self, *row):
+        for (i, value) in enumerate(row):
+            (symbol, relative) = self.kinds[i]
+            if symbol:
+                value = self.intern(self.columns[i], value)
+            if relative:
+                (value, self.last[i]) = (value - self.last[i], value)
+            self.arrays[i].append(value)
+
+    def intern(self, name, string):
+        index = self.indexes[name].get(string)
+        if index is None:
+            index = len(self.symbols[name])
+            self.symbols[name].append(string)
+            self.indexes[name][string] = index
+        return index
+
+    def build(self):
+        if sys.byteorder != 'little':
+            for values in self.arrays:
+                values.byteswap()
+        data = b''.join(values.tobytes() for values in self.arrays)
+        rows = len(self.arrays[0]) if self.arrays else 0
+        return Columns(self.columns, rows, data, self.symbols,
+                       self.relative)
+
+# A TokensBuilder makes the table of a tokens product (see products.md),
+# with the offsets sent as differences and the categories as symbols. Its
+# add takes the offset, length and category of a token, in order of
+# offset, and is quicker than the general one.
+
+TOKEN_COLUMNS = ['offset', 'length', 'category']
+
+
+class TokensBuilder(ColumnsBuilder):
+    def __init__(self, base=None):
+        super().__init__(TOKEN_COLUMNS, symbols=['category'],
+                         relative=['offset'], base=base)
+        (self.offsets, self.lengths, self.categories) = self.arrays
+        self.offset = 0
+        self.categories_index = self.indexes['category']
+
+    def add(self, offset, length, category):
+        self.offsets.append(offset - self.offset)
+        self.offset = offset
+        self.lengths.append(length)
+        index = self.categories_index.get(category)
+        if index is None:
+            index = self.intern('category', category)
+        self.categories.append(index)
+
+# A TableSplicer lets a server send splices instead of whole tables. It
+# keeps the last table that it was given for each source and product name
+# and returns the splice of the next one, except that every full_every-th
+# table is returned whole. A server should build each table with the last
+# one as its base (see ColumnsBuilder) so that their symbols agree.
+
+SPLICE_FULL_EVERY = 100
+
+
+class TableSplicer:
+    def __init__(self, full_every=SPLICE_FULL_EVERY):
+        self.full_every = full_every
+        self.tables = {}
+
+    def last(self, source, product):
+        return self.tables.get((source, product), (None, 0))[0]
+
+    def splice(self, source, product, table):
+        key = (source, product)
+        (previous, count) = self.tables.get(key, (None, 0))
+        self.tables[key] = (table, count + 1)
+        if count % self.full_every == 0:
+            return table
+        return table.splice_of(previous)
+
+# A ColumnTables keeps the latest whole table of each source and product
+# name that a receiver has seen, so that it can turn the splices that it
+# receives into whole tables. apply returns the topic and frames of the
+# whole product for a product that has been received, or None if it is a
+# splice whose base table is missing. The source and product name of such
+# splices are kept in missing, and the receiver should catch up by asking
+# the broker for its cached product (see resync_tables), which the broker
+# keeps whole.
+
+
+class ColumnTables:
+    def __init__(self):
+        self.tables = {}
+        self.missing = []
+
+    def apply(self, topic, frames):
+        if len(frames) < 2:
+            return (topic, frames)
+        header = decode_header(frames)
+        if header.get('encoding') != 'columns':
+            return (topic, frames)
+        key = (header['source'], header['product'])
+        if 'splice' in header:
+            frames = apply_splice(self.tables.get(key), frames)
+            if frames is None:
+                self.tables.pop(key, None)
+                self.missing.append(key)
+                return None
+        self.tables[key] = frames
+        return (topic, frames)
+
+    def take_missing(self):
+        (missing, self.missing) = (self.missing, [])
+        return missing
+
+# Receive the whole tables of the splices that tables couldn't apply from
+# the broker. Returns the topic and frames of each of them.
+
+
+def resync_tables(context, tables):
+    messages = []
+    for (source, product) in tables.take_missing():
+        for message in request_products(context, product, sources=source):
+            message = tables.apply(*message)
+            if message is not None:
+                messages.append(message)
+    return messages
+
+
+async def async_resync_tables(context, tables):
+    messages = []
+    for (source, product) in tables.take_missing():
+        for message in await async_request_products(context, product,
+                                                    sources=source):
+            message = tables.apply(*message)
+            if message is not None:
+                messages.append(message)
+    return messages
+
+# Tracing
+
+# A version can carry a 'trace' field to find out where the time goes on
+# its way from a source to the sinks. The trace is an object with an 'id'
+# and a list of 'hops', each a pair of a name and the time (in seconds
+# since the epoch) that the version or product got there. The hops are:
+# 'publish' and 'send' when the source publishes and sends the version,
+# 'broker' and 'flush' when the broker receives and publishes it, 'server'
+# when a server receives it, 'call' and 'return' around the server function
+# (or 'cached' if the result came from the cache), 'respond' when the
+# server sends the products, 'forward' when the broker publishes them and
+# 'sink' when a sink receives them. Products carry the trace of the version
+# that they were made from. Nothing is added to messages without a trace,
+# so tracing costs next to nothing when it is off. latency.py summarises
+# the hops of traced products.
+
+
+def new_trace():
+    return {'id': os.urandom(8).hex(), 'hops': [['publish', time.time()]]}
+
+
+def trace_hop(message, name):
+    trace = message.get('trace')
+    if trace is not None:
+        trace['hops'].append([name, time.time()])
+
+# Give encoded products the trace of version, if it has one, with a
+# 'respond' hop.
+
+
+def traced_frames(version, frames):
+    trace = version.get('trace')
+    if trace is None:
+        return frames
+    hops = trace['hops'] + [['respond', time.time()]]
+    traced = []
+    for i in range(0, len(frames), 2):
+        header = decode_header(frames[i:i + 2])
+        header['trace'] = {'id': trace['id'], 'hops': hops}
+        traced.append(encode_header(header))
+        traced.extend(frames[i + 1:i + 2])
+    return traced
+
+# Pipelining
+
+# Sources and servers send messages to the broker on sockets where the
+# broker replies to each message with ACK (or RESYNC, see below). A plain
+# ZeroMQ REQ socket has to wait for each reply before it can send the next
+# message. A Pipeline instead uses a DEALER socket and keeps up to window
+# messages in flight. Each message is preceded by an empty delimiter frame
+# and a sequence frame: '#' followed by the decimal sequence number of the
+# message. The broker collects the ACKs for all of the messages that it
+# receives from a peer in one go and replies with a single ACK followed by
+# the highest sequence frame, which acknowledges every message up to that
+# one. Other replies are sent immediately and are followed by the sequence
+# frame of the message they refer to. They are still covered by the next
+# ACK. Messages from REQ sockets have no sequence frame and are replied to
+# one at a time as before.
+
+# Brokers that only serve REQ sockets, such as the C broker, read a single
+# frame from each message and don't send sequence frames back. Setting
+# 'pipeline' to false in the 'connections' section makes every Pipeline
+# talk to the broker as a REQ socket would: each message is sent as a
+# single JSON frame with the contents in its 'contents' field (one message
+# for each product), and the Pipeline waits for the reply to each message
+# before it sends the next one.
+
+SEQUENCE_PREFIX = b'#'
+WINDOW = monto_connection_or_default('window', 64)
+PIPELINE = monto_connection_or_default('pipeline', True)
+
+
+def sequence_frame(sequence):
+    return SEQUENCE_PREFIX + str(sequence).encode()
+
+# Frames can be memoryviews (see recv_frames), so they are compared as
+# bytes. A large single-frame message from a REQ socket must not be taken
+# for a sequence frame.
+
+
+def is_sequence(frame):
+    return bytes(frame[:len(SEQUENCE_PREFIX)]) == SEQUENCE_PREFIX
+
+
+class Pipeline:
+    def __init__(self, context, address, window=WINDOW, sequenced=PIPELINE):
+        self.socket = context.socket(zmq.DEALER)
+        connect(self.socket, address)
+        self.sequenced = sequenced
+        self.window = window if sequenced else 1
+        self.sequence = 0
+        self.acked = 0
+        self.tags = {}
+        self.replies = []
+
+    # Send a message. If tag is not None, it is returned along with any
+    # reply other than ACK that the broker makes to the message.
+
+    def send(self, frames, tag=None):
+        for message in self._messages(frames):
+            while self.full():
+                self._receive(0)
+            self.socket.send_multipart(self._number(message, tag),
+                                       copy=False)
+        self.poll()
+
+    def full(self):
+        return self.sequence - self.acked >= self.window
+
+    # Send a message if the window isn't full, without waiting. Returns
+    # whether it was sent.
+
+    def offer(self, frames, tag=None):
+        self.poll()
+        if self.full():
+            return False
+        self.send(frames, tag)
+        return True
+
+    def flushed(self):
+        return self.acked == self.sequence
+
+    def _messages(self, frames):
+        if self.sequenced or len(frames) == 1:
+            return [frames]
+        return [[legacy_frame(frames[i:i + 2])]
+                for i in range(0, len(frames), 2)]
+
+    def _number(self, frames, tag):
+        self.sequence += 1
+        if tag is not None:
+            self.tags[self.sequence] = tag
+        if not self.sequenced:
+            return [b''] + frames
+        return [b'', sequence_frame(self.sequence)] + frames
+
+    # Receive any replies that have arrived without waiting for more.
+
+    def poll(self):
+        while self._receive(zmq.NOBLOCK):
+            pass
+
+    # Wait until all messages have been acknowledged.
+
+    def flush(self):
+        while self.acked < self.sequence:
+            self._receive(0)
+
+    # Return the replies other than ACK that have been received since the
+    # last call as a list of triples of reply, sequence number and tag.
+
+    def take_replies(self):
+        replies = self.replies
+        self.replies = []
+        return replies
+
+    def close(self):
+        self.socket.close()
+
+    def _receive(self, flags):
+        try:
+            frames = self.socket.recv_multipart(flags)
+        except zmq.Again:
+            return False
+        self._reply(frames)
+        return True
+
+    def _reply(self, frames):
+        reply = frames[1]
+        if self.sequenced:
+            sequence = int(frames[2][len(SEQUENCE_PREFIX):])
+        else:
+            sequence = self.acked + 1
+        if reply == ACK:
+            for acked in range(self.acked + 1, sequence + 1):
+                self.tags.pop(acked, None)
+            self.acked = max(self.acked, sequence)
+        else:
+            self.replies.append((reply, sequence,
+                                 self.tags.pop(sequence, None)))
+
+# A Pipeline for use with asyncio. The socket must be created from a
+# zmq.asyncio context. The lock stops concurrent tasks from interleaving
+# their waits for replies.
+
+
+class AsyncPipeline(Pipeline):
+    def __init__(self, context, address, window=WINDOW, sequenced=PIPELINE):
+        Pipeline.__init__(self, context, address, window, sequenced)
+        self.lock = asyncio.Lock()
+
+    async def send(self, frames, tag=None):
+        async with self.lock:
+            for message in self._messages(frames):
+                while self.full():
+                    self._reply(await self.socket.recv_multipart())
+                await self.socket.send_multipart(self._number(message, tag),
+                                                 copy=False)
+            await self._poll()
+
+    async def poll(self):
+        async with self.lock:
+            await self._poll()
+
+    async def _poll(self):
+        while await self.socket.poll(0):
+            self._reply(await self.socket.recv_multipart())
+
+    async def flush(self):
+        async with self.lock:
+            while self.acked < self.sequence:
+                self._reply(await self.socket.recv_multipart())
+
+# A Shards holds a Pipeline to each of a list of addresses, one for each
+# broker shard (see Shards above), and sends messages to the shard of
+# their source. pipeline returns the Pipeline for a source. send sends a
+# message that contains products, splitting it by the shards of their
+# sources, and offer does the same without waiting (see Pipeline.offer),
+# returning the number of products that weren't sent. The other methods
+# apply to all of the pipelines.
+
+
+class Shards:
+    def __init__(self, context, addresses, window=WINDOW,
+                 pipeline=Pipeline):
+        self.pipelines = [pipeline(context, address, window)
+                          for address in addresses]
+
+    def pipeline(self, source):
+        return self.pipelines[shard_of(source, len(self.pipelines))]
+
+    def send(self, frames, tag=None):
+        for (pipeline, group, _) in self.split(frames):
+            pipeline.send(group, tag)
+
+    def offer(self, frames, tag=None):
+        dropped = 0
+        for (pipeline, group, count) in self.split(frames):
+            if not pipeline.offer(group, tag):
+                dropped += count
+        return dropped
+
+    def split(self, frames):
+        if len(self.pipelines) == 1:
+            return [(self.pipelines[0], frames, len(frames) // 2)]
+        groups = collections.OrderedDict()
+        for product in split_products(frames):
+            pipeline = self.pipeline(decode_header(product)['source'])
+            groups.setdefault(pipeline, []).extend(product)
+        return [(pipeline, group, len(group) // 2)
+                for (pipeline, group) in groups.items()]
+
+    def poll(self):
+        for pipeline in self.pipelines:
+            pipeline.poll()
+
+    def flush(self):
+        for pipeline in self.pipelines:
+            pipeline.flush()
+
+    def flushed(self):
+        return all(pipeline.flushed() for pipeline in self.pipelines)
+
+    def take_replies(self):
+        return [reply for pipeline in self.pipelines
+                for reply in pipeline.take_replies()]
+
+    def sockets(self):
+        return [pipeline.socket for pipeline in self.pipelines]
+
+    def close(self):
+        for pipeline in self.pipelines:
+            pipeline.close()
+
+
+class AsyncShards(Shards):
+    def __init__(self, context, addresses, window=WINDOW):
+        Shards.__init__(self, context, addresses, window, AsyncPipeline)
+
+    async def send(self, frames, tag=None):
+        for (pipeline, group, _) in self.split(frames):
+            await pipeline.send(group, tag)
+
+    async def poll(self):
+        for pipeline in self.pipelines:
+            await pipeline.poll()
+
+    async def flush(self):
+        for pipeline in self.pipelines:
+            await pipeline.flush()
+
+# Receive the messages that are waiting on a ROUTER socket, at most limit
+# of them, and reply to them. handle is called with the frames of each
+# message and returns the reply, which is a single frame or a list of
+# frames.
+
+
+def serve_requests(socket, handle, limit=1000):
+    acks = {}
+    for _ in range(limit):
+        try:
+            frames = recv_frames(socket, zmq.NOBLOCK)
+        except zmq.Again:
+            break
+        identity = frames[0]
+        frames = frames[2:]
+        if frames and is_sequence(frames[0]):
+            sequence = frames.pop(0)
+        else:
+            sequence = None
+        reply = handle(frames)
+        if not isinstance(reply, list):
+            reply = [reply]
+        if sequence is None:
+            socket.send_multipart([identity, b''] + reply, copy=False)
+        else:
+            if reply != [ACK]:
+                socket.send_multipart([identity, b''] + reply + [sequence],
+                                      copy=False)
+            acks[identity] = sequence
+    for identity, sequence in acks.items():
+        socket.send_multipart([identity, b'', ACK, sequence])
+
+# Documents
+
+# Rather than sending the whole contents with every version, a source can
+# send just the edits that it has made since its previous version. A
+# version header with an 'edits' field and no contents frame describes such
+# a change. Each edit is an object with 'begin' and 'end' fields that give
+# the range of text to replace (counting characters from zero as for
+# selections) and a 'text' field with the replacement text. Edits are
+# applied in order, each to the result of the previous one.
+
+# Versions are numbered by a 'revision' field that the source increments
+# each time the text changes. An edit header also has a 'base' field that
+# is the revision the edits apply to. A header with neither contents nor
+# edits only changes the selections of the current revision, so a cursor
+# movement doesn't need to send any text.
+
+# The broker keeps the current text of each source as a document so that
+# it can reconstruct full versions for servers. If it can't apply some
+# edits because it doesn't have their base revision (e.g., because it has
+# been restarted), it replies to the source with RESYNC instead of ACK and
+# the source sends its full contents.
+
+ACK = b'ack'
+RESYNC = b'resync'
+
+
+def apply_edits(text, edits):
+    for edit in edits:
+        text = text[:edit['begin']] + edit['text'] + text[edit['end']:]
+    return text
+
+# A document holds its contents as bytes or text, whichever it was last
+# given, and converts to the other form only when asked for it. Hence the
+# broker doesn't decode the contents of sources that never send edits. The
+# bytes can be any bytes-like object (see Message encoding).
+# published is the header of the last version of the document that the
+# broker published, if any.
+
+
+def new_document(revision, contents):
+    if isinstance(contents, str):
+        return Document(revision, text=contents)
+    else:
+        return Document(revision, data=contents)
+
+
+class Document:
+    def __init__(self, revision, data=None, text=None, hash=None):
+        self.revision = revision
+        self.published = None
+        self._data = data
+        self._text = text
+        self._hash = hash
+
+    def data(self):
+        if self._data is None:
+            self._data = self._text.encode()
+        return self._data
+
+    def text(self):
+        if self._text is None:
+            self._text = frame_text(self._data)
+        return self._text
+
+    # Return the contents in whichever form the document has them.
+
+    def contents(self):
+        return self._text if self._data is None else self._data
+
+    def hash(self):
+        if self._hash is None:
+            self._hash = content_hash(self.data())
+        return self._hash
+
+    def apply(self, edits, revision):
+        self._text = apply_edits(self.text(), edits)
+        self._data = None
+        self._hash = None
+        self.revision = revision
+
+# broker
+
+# The Monto broker. Waits for versions to come in from sources. Each version
+# is published to the servers. Products from servers are published to the
+# sinks. Both are published under a routing topic (see above).
+
+# The broker keeps a document for each source. Each version is published
+# twice: once in full on a version topic, and once on a delta topic with
+# the edits that were made since the last version that was published for
+# that source. Delta messages contain the full contents instead if the
+# source sent full contents since then.
+
+# The broker also keeps the latest product for each source and product
+# name in a ProductCache. A sink that starts after a product was published
+# can ask for the cached products on the from_sinks socket (see
+# request_products) instead of waiting for the user to make a change.
+
+# The broker keeps statistics about the messages that pass through it and
+# the time that it spends on them in a BrokerStats and replies to any
+# request on the stats socket with them (see request_stats).
+
+# Every message that the broker receives from a source is also published
+# as it came on the tap socket under source_topic(), so that tools such as
+# record.py can see what sources send before it is coalesced.
+
+# At most SINK_HWM products are queued for each sink. Products that can't
+# be queued for a sink wait in the broker, where they are conflated (see
+# SinkPublisher). Sinks that can fall behind should still use a
+# ProductQueue (see sink) so that they keep up with the socket and don't
+# hold up the other sinks.
+
+# If threads is True, the version path (from sources to servers) and the
+# product path (from servers to sinks) each run in a thread of their own
+# (see run_path), so that a burst of large products doesn't hold up the
+# versions for servers and vice versa. Each path owns all of its state,
+# including its statistics. The main thread only answers requests for
+# statistics, which it gets from each path over an inproc control socket.
+# ZeroMQ is given an I/O thread for each path as well. threads defaults to
+# the 'threads' setting in the 'broker' section of .monto.
+
+# shard is the index of the shard (see Shards) whose addresses the broker
+# binds. Each shard is a broker process of its own.
+
+# The broker can also forward what passes through it to brokers elsewhere,
+# such as on another host, so that they can be federated. The 'forward'
+# setting in the 'broker' section of .monto is a list of the shards of the
+# other brokers, each with a 'from_sources' address, a 'from_servers'
+# address or both. The broker forwards the versions that it publishes to
+# the 'from_sources' addresses as a source would, and the products of its
+# servers to the 'from_servers' addresses as a server would, each to the
+# shard of its source. Forwarded messages are marked with a 'forwarded'
+# field and are never forwarded again. Since the other brokers' servers
+# don't mark the products that they make from forwarded versions, two
+# brokers should forward versions one way and products the other (or not
+# at all), rather than both forwarding both. Forwarding never holds up the
+# broker: a message that doesn't fit in the pipeline to the other broker is
+# dropped, and the next version of its source is forwarded with full
+# contents.
+
+
+def broker(threads=THREADS, shard=0, forward=FORWARD):
+    if not 0 <= shard < len(SHARDS):
+        error('there is no shard {0}'.format(shard))
+        sys.exit(3)
+    addresses = SHARDS[shard]
+    stats = BrokerStats()
+    if threads:
+        context = zmq.Context(2)
+        paths = [VersionPath(context, BrokerStats(), addresses, forward),
+                 ProductPath(context, BrokerStats(), addresses, forward)]
+    else:
+        context = zmq.Context()
+        paths = [VersionPath(context, stats, addresses, forward),
+                 ProductPath(context, stats, addresses, forward)]
+    tostats = context.socket(zmq.ROUTER)
+    bind(tostats, addresses['stats'])
+    if threads:
+        broker_threads(context, paths, stats, tostats)
+        return
+
+    poller = zmq.Poller()
+    for path in paths:
+        path.register(poller)
+    poller.register(tostats, zmq.POLLIN)
+
+    while True:
+        # print('broker: waiting')
+        start = time.perf_counter()
+        ready = dict(poller.poll(poll_timeout(paths)))
+        start = stats.phase('wait', start)
+        for path in paths:
+            start = path.handle(ready, start)
+        if ready.get(tostats) == zmq.POLLIN:
+            serve_requests(tostats, lambda frames: encode_header(
+                merge_snapshots(stats, [path.snapshot() for path in paths])))
+            stats.phase('stats', start)
+
+
+def poll_timeout(paths):
+    timeouts = [timeout for timeout in (path.timeout() for path in paths)
+                if timeout is not None]
+    return min(timeouts) if timeouts else None
+
+# The version path receives versions from sources, coalesces them (see
+# VersionScheduler) and publishes them to servers.
+
+
+class VersionPath:
+    name = 'versions'
+
+    def __init__(self, context, stats, addresses, forward=()):
+        self.fromsources = context.socket(zmq.ROUTER)
+        bind(self.fromsources, addresses['from_sources'])
+        self.toservers = context.socket(zmq.PUB)
+        bind(self.toservers, addresses['to_servers'])
+        self.tap = context.socket(zmq.PUB)
+        bind(self.tap, addresses['tap'])
+        self.fromgroups = bind_groups(context, addresses.get('groups'))
+        self.documents = {}
+        self.scheduler = VersionScheduler(DEBOUNCE, MAX_HOLD)
+        self.groups = ServerGroups(HEARTBEAT, LIVENESS)
+        self.stats = stats
+        self.forward = forward_shards(context, forward, 'from_sources')
+        self.stale = set()
+        self.resynced = {}
+        self.forwarded = {'sent': 0, 'dropped': 0, 'resyncs': 0}
+
+    def register(self, poller):
+        poller.register(self.fromsources, zmq.POLLIN)
+        if self.fromgroups is not None:
+            poller.register(self.fromgroups, zmq.POLLIN)
+        if self.forward:
+            for socket in self.forward.sockets():
+                poller.register(socket, zmq.POLLIN)
+
+    def timeout(self):
+        now = time.monotonic()
+        timeouts = [timeout for timeout in (self.scheduler.timeout(now),
+                                            self.groups.timeout(now))
+                    if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    # Deal with the sockets that are ready and return the time at which
+    # it finished (see BrokerStats.phase).
+
+    def handle(self, ready, start):
+        if ready.get(self.fromsources) == zmq.POLLIN:
+            serve_requests(self.fromsources, lambda frames:
+                           receive_version(frames, self.documents,
+                                           self.scheduler, self.stats,
+                                           self.tap))
+            start = self.stats.phase('sources', start)
+        if ready.get(self.fromgroups) == zmq.POLLIN:
+            self.receive_heartbeats()
+            start = self.stats.phase('groups', start)
+        self.reassign(self.groups.expire(time.monotonic()))
+        # Send any messages that are due
+        due = self.scheduler.take_due(time.monotonic())
+        for message in due:
+            # print('broker: sending {0!s}'.format(message))
+            document = self.documents[message['source']]
+            header = flush_version(self.toservers, document, message,
+                                   self.stats)
+            for group in self.groups.groups.values():
+                replica = group.assign(header['source'], header['language'])
+                if replica is not None:
+                    publish_replica(self.toservers, replica, document, header)
+            if self.forward and not header.get('forwarded'):
+                self.forward_version(document, header, message)
+        if due:
+            start = self.stats.phase('publish', start)
+        if self.forward and any(ready.get(socket) == zmq.POLLIN
+                                for socket in self.forward.sockets()):
+            self.forward.poll()
+            self.forward_resyncs()
+            start = self.stats.phase('forward', start)
+        return start
+
+    # Deal with the heartbeats of the members of server groups, welcoming
+    # new members and passing on the versions that members that have left
+    # were working on.
+
+    def receive_heartbeats(self):
+        now = time.monotonic()
+        while True:
+            try:
+                frames = self.fromgroups.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            header = decode_header(frames[-1:])
+            (replica, orphans) = self.groups.beat(header, now)
+            if replica is not None and not replica.ready:
+                self.toservers.send_multipart([
+                    replica.topic + WELCOME_TOPIC,
+                    encode_header({'shard': header.get('shard')})])
+            self.reassign(orphans)
+
+    # Send the last published version of each source that a member was
+    # working on when it left to another member of its group, unless a
+    # newer version is waiting to be published.
+
+    def reassign(self, orphans):
+        for (group, source) in orphans:
+            document = self.documents.get(source)
+            if source in self.scheduler.messages or document is None or \
+                    document.published is None:
+                continue
+            header = dict(document.published, revision=document.revision)
+            header.pop('base', None)
+            header.pop('edits', None)
+            replica = group.assign(source, header['language'])
+            if replica is not None:
+                publish_replica(self.toservers, replica, document, header)
+                self.groups.stats['reassigned'] += 1
+
+    # Forward a version that has just been published as a delta, or with
+    # full contents if there is no delta or the other broker may not have
+    # the base of the delta.
+
+    def forward_version(self, document, header, message):
+        source = header['source']
+        if message['edits'] is None or message['base'] is None or \
+                source in self.stale:
+            self.send_forward(source, forward_full(header, document))
+        else:
+            self.send_forward(source, [encode_header(
+                dict(header, forwarded=True))])
+
+    def send_forward(self, source, frames):
+        pipeline = self.forward.pipeline(source)
+        if pipeline.offer(frames, source):
+            self.forwarded['sent'] += 1
+            if len(frames) > 1:
+                self.stale.discard(source)
+                self.resynced[source] = pipeline.sequence
+        else:
+            self.forwarded['dropped'] += 1
+            self.stale.add(source)
+
+    # Send the full contents of documents whose deltas the other broker
+    # couldn't apply, unless a version of them is waiting to be published
+    # (which will then be forwarded with full contents).
+
+    def forward_resyncs(self):
+        for reply, sequence, source in self.forward.take_replies():
+            if reply != RESYNC or sequence <= self.resynced.get(source, 0):
+                continue
+            self.forwarded['resyncs'] += 1
+            self.stale.add(source)
+            document = self.documents.get(source)
+            if source not in self.scheduler.messages and document and \
+                    document.published is not None:
+                header = dict(document.published,
+                              revision=document.revision)
+                self.send_forward(source, forward_full(header, document))
+
+    def snapshot(self):
+        snapshot = self.stats.version_snapshot()
+        snapshot['documents'] = len(self.documents)
+        snapshot['queued'] = len(self.scheduler.messages)
+        snapshot['scheduler'] = self.scheduler.stats
+        if self.forward:
+            snapshot['forwarded_versions'] = self.forwarded
+        if self.groups.groups:
+            snapshot['groups'] = self.groups.snapshot()
+        return snapshot
+
+
+# Bind the groups socket (see Server groups). A broker that can't bind it
+# (e.g., because another broker with the default address is running)
+# carries on without server groups.
+
+
+def bind_groups(context, address):
+    if not address:
+        return None
+    socket = context.socket(zmq.ROUTER)
+    try:
+        bind(socket, address)
+    except zmq.ZMQError as err:
+        error('can\'t bind {0}, server groups are disabled: {1!s}'.format(
+            address, err))
+        socket.close()
+        return None
+    return socket
+
+
+def forward_full(header, document):
+    header = dict(header, forwarded=True)
+    header.pop('base', None)
+    header.pop('edits', None)
+    return [encode_header(header), document.data()]
+
+# Return the Shards of the addresses called name in the forward setting
+# (see broker), or None if none of them have one.
+
+
+def forward_shards(context, forward, name):
+    addresses = [shard[name] for shard in forward if name in shard]
+    return Shards(context, addresses) if addresses else None
+
+# The product path receives products from servers, publishes them to sinks
+# and answers the requests of sinks for cached products.
+
+
+class ProductPath:
+    name = 'products'
+
+    def __init__(self, context, stats, addresses, forward=()):
+        self.fromservers = context.socket(zmq.ROUTER)
+        bind(self.fromservers, addresses['from_servers'])
+        self.tosinks = SinkPublisher(context, addresses['to_sinks'])
+        self.fromsinks = context.socket(zmq.ROUTER)
+        bind(self.fromsinks, addresses['from_sinks'])
+        self.products = ProductCache(CACHE_ENTRIES, CACHE_SIZE,
+                                     CACHE_EVICTION)
+        self.stats = stats
+        self.forward = forward_shards(context, forward, 'from_servers')
+        self.forwarded = {'sent': 0, 'dropped': 0}
+
+    def register(self, poller):
+        poller.register(self.fromservers, zmq.POLLIN)
+        poller.register(self.fromsinks, zmq.POLLIN)
+        poller.register(self.tosinks.socket, zmq.POLLIN)
+
+    def timeout(self):
+        return self.tosinks.timeout()
+
+    def handle(self, ready, start):
+        if ready.get(self.tosinks.socket) == zmq.POLLIN:
+            self.tosinks.subscriptions()
+        if self.tosinks.waiting:
+            self.tosinks.retry()
+            start = self.stats.phase('retry', start)
+        if ready.get(self.fromservers) == zmq.POLLIN:
+            serve_requests(self.fromservers, lambda frames:
+                           receive_products(frames, self.tosinks,
+                                            self.products, self.stats,
+                                            self.forward_products))
+            start = self.stats.phase('servers', start)
+        if ready.get(self.fromsinks) == zmq.POLLIN:
+            serve_requests(self.fromsinks, lambda frames:
+                           replay_products(frames, self.products))
+            start = self.stats.phase('sinks', start)
+        return start
+
+    # Forward the products that came from servers to the other brokers.
+    # Replies from them are just taken, since a product that doesn't get
+    # there is soon replaced by the next one.
+
+    def forward_products(self, products):
+        if not self.forward:
+            return
+        self.forward.take_replies()
+        frames = [frame for product in products for frame in product]
+        dropped = self.forward.offer(frames) if frames else 0
+        self.forwarded['sent'] += len(products) - dropped
+        self.forwarded['dropped'] += dropped
+
+    def snapshot(self):
+        snapshot = self.stats.product_snapshot()
+        snapshot['cache'] = self.products.stats
+        snapshot['sinks'] = self.tosinks.snapshot()
+        if self.forward:
+            snapshot['forwarded_products'] = self.forwarded
+        return snapshot
+
+# Publishing to sinks
+
+# A SinkPublisher publishes products to sinks on an XPUB socket. ZeroMQ
+# queues at most SINK_HWM products for each sink. A plain PUB socket drops
+# arbitrary products for a sink whose queue is full, but XPUB_NODROP makes
+# ZeroMQ refuse to send a product instead. The product then waits in the
+# broker, and so do the products that come after it until the sinks have
+# caught up. A newer product replaces a waiting one with the same topic
+# (source and product name), so a sink that falls behind gets the latest
+# product of each source and product name instead of missing arbitrary
+# ones. Such products are counted as 'conflated'. Waiting products are
+# tried again every SINK_RETRY milliseconds.
+
+# A sink that has stopped reading would hold up all of the others, so once
+# the sinks have had no room for timeout milliseconds (the 'sink_timeout'
+# setting of the 'broker' section), the oldest waiting product is sent
+# anyway. ZeroMQ drops it for the sinks that are full, and it is counted
+# as 'dropped'. ZeroMQ then leaves those sinks out until they catch up, so
+# the other waiting products can be sent, but the products that those
+# sinks miss until then can't be counted.
+
+SINK_RETRY = 10
+
+
+class SinkPublisher:
+    def __init__(self, context, address, hwm=SINK_HWM, timeout=SINK_TIMEOUT):
+        self.socket = context.socket(zmq.XPUB)
+        self.socket.setsockopt(zmq.SNDHWM, hwm)
+        self.socket.setsockopt(zmq.XPUB_NODROP, 1)
+        bind(self.socket, address)
+        self.wait = timeout / 1000
+        self.waiting = collections.OrderedDict()
+        self.blocked = None
+        self.stats = {'conflated': 0, 'dropped': 0}
+
+    def publish(self, topic, frames):
+        if not self.waiting and self._send(topic, frames):
+            return
+        if topic in self.waiting:
+            self.stats['conflated'] += 1
+        elif self.blocked is None:
+            self.blocked = time.monotonic()
+        self.waiting[topic] = frames
+
+    def _send(self, topic, frames):
+        try:
+            self.socket.send_multipart([topic] + frames, zmq.NOBLOCK,
+                                       copy=False)
+        except zmq.Again:
+            return False
+        return True
+
+    # Send the waiting products that the sinks have room for.
+
+    def retry(self):
+        while self.waiting:
+            (topic, frames) = next(iter(self.waiting.items()))
+            if not self._send(topic, frames):
+                now = time.monotonic()
+                if now - self.blocked < self.wait:
+                    return
+                self.socket.setsockopt(zmq.XPUB_NODROP, 0)
+                self._send(topic, frames)
+                self.socket.setsockopt(zmq.XPUB_NODROP, 1)
+                self.stats['dropped'] += 1
+                self.blocked = now
+            del self.waiting[topic]
+        self.blocked = None
+
+    def timeout(self):
+        return SINK_RETRY if self.waiting else None
+
+    # Take the subscription messages that sinks send to the socket. The
+    # socket filters products itself, so they aren't needed.
+
+    def subscriptions(self):
+        while True:
+            try:
+                self.socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+    def snapshot(self):
+        return dict(self.stats, waiting=len(self.waiting))
+
+# Combine the statistics of the paths into the reply to a stats request.
+
+
+def merge_snapshots(stats, snapshots):
+    merged = {'uptime': time.monotonic() - stats.started, 'phases': {}}
+    for snapshot in snapshots:
+        snapshot = dict(snapshot)
+        merged['phases'].update(snapshot.pop('phases'))
+        merged.update(snapshot)
+    return merged
+
+# Run each path in a thread and answer requests for statistics. A path
+# thread waits for its own sockets and its control socket, on which the
+# main thread asks for its statistics. Its wait is recorded as a phase
+# named after the path. The broker stops if a path thread dies.
+
+CONTROL_ADDRESS = 'inproc://monto-{0}'
+
+
+def broker_threads(context, paths, stats, tostats):
+    controls = []
+    threads = []
+    for path in paths:
+        control = context.socket(zmq.PAIR)
+        control.bind(CONTROL_ADDRESS.format(path.name))
+        thread = threading.Thread(target=run_path, args=(context, path),
+                                  daemon=True)
+        thread.start()
+        controls.append(control)
+        threads.append(thread)
+    while all(thread.is_alive() for thread in threads):
+        if tostats.poll(1000):
+            serve_requests(tostats, lambda frames: encode_header(
+                merge_snapshots(stats, [request_snapshot(control)
+                                        for control in controls])))
+    error('a broker path thread has stopped')
+    sys.exit(1)
+
+
+def run_path(context, path):
+    control = context.socket(zmq.PAIR)
+    control.connect(CONTROL_ADDRESS.format(path.name))
+    poller = zmq.Poller()
+    path.register(poller)
+    poller.register(control, zmq.POLLIN)
+    wait = 'wait ' + path.name
+    while True:
+        start = time.perf_counter()
+        ready = dict(poller.poll(path.timeout()))
+        start = path.stats.phase(wait, start)
+        start = path.handle(ready, start)
+        if ready.get(control) == zmq.POLLIN:
+            control.recv()
+            control.send(encode_header(path.snapshot()))
+
+
+def request_snapshot(control):
+    control.send(b'')
+    return decode_header([control.recv()])
+
+# Version scheduling
+
+# The broker doesn't publish every version that it receives. Versions that
+# arrive in quick succession for the same source are coalesced into one.
+# A version is held until its source has been quiet for the debounce
+# window, but never for longer than the maximum hold time after the first
+# version that it coalesces, so continuous typing can't hold versions
+# indefinitely. A version from a source that has been quiet for the
+# debounce window is published straight away.
+
+# Published versions have a 'coalesced' field with the number of versions
+# that were received for them and a 'held' field with the time in
+# milliseconds that the first of them was held. The scheduler also keeps
+# totals of both in stats.
+
+# Versions can have a 'priority' field: 'interactive' for the versions
+# that a user is waiting for, such as those of the buffer that has the
+# focus in an editor, or 'background' for bulk traffic, such as indexing a
+# whole project (see PRIORITIES). Due messages are taken in order of
+# priority and then in the order in which their sources first queued
+# them, so each source gets its turn, and at most FLUSH_BATCH at a time so
+# that the broker reads new versions in between. A coalesced message has
+# the highest priority of its versions. While there have been interactive
+# versions within the last interactive_window milliseconds, background
+# messages are only taken at background_rate per second (a token bucket
+# that holds up to a second's worth), and meanwhile keep coalescing. The
+# 'throttled' stat counts the messages that were held back in this way.
+
+PRIORITIES = {'interactive': 0, 'normal': 1, 'background': 2}
+PRIORITY_NAMES = sorted(PRIORITIES, key=PRIORITIES.get)
+NORMAL = PRIORITIES['normal']
+BACKGROUND = PRIORITIES['background']
+FLUSH_BATCH = 64
+
+
+def priority_rank(priority):
+    return PRIORITIES.get(priority, NORMAL)
+
+
+class VersionScheduler:
+    def __init__(self, debounce, max_hold, background_rate=BACKGROUND_RATE,
+                 interactive_window=INTERACTIVE_WINDOW):
+        self.debounce = debounce / 1000
+        self.max_hold = max_hold / 1000
+        self.rate = background_rate
+        self.window = interactive_window / 1000
+        self.interactive = None
+        self.tokens = 0.0
+        self.refilled = None
+        self.messages = {}
+        self.received = {}
+        self.stats = {
+            'versions_in': 0,
+            'versions_out': 0,
+            'coalesced': 0,
+            'held_total': 0.0,
+            'held_max': 0.0,
+            'duplicates': 0,
+            'throttled': 0
+        }
+
+    # Return the queued message for source, starting a new one if there
+    # isn't one. The message is a dict that the caller fills in.
+
+    def queue(self, source, now, priority=None):
+        self.stats['versions_in'] += 1
+        rank = priority_rank(priority)
+        if rank < NORMAL:
+            self.interactive = now
+        last = self.received.get(source)
+        self.received[source] = now
+        message = self.messages.get(source)
+        if message is None:
+            if last is None or now - last >= self.debounce:
+                deadline = now
+            else:
+                deadline = now + self.debounce
+            message = {
+                'source': source,
+                'first': now,
+                'deadline': deadline,
+                'count': 0,
+                'rank': rank
+            }
+            self.messages[source] = message
+        else:
+            message['deadline'] = min(now + self.debounce,
+                                      message['first'] + self.max_hold)
+            message['rank'] = min(message['rank'], rank)
+        message['count'] += 1
+        return message
+
+    # Return the number of milliseconds until the next message is due, or
+    # None if there are no queued messages.
+
+    def timeout(self, now):
+        if self.messages:
+            return max(0, (self.next_ready(now) - now) * 1000)
+        else:
+            return None
+
+    # Return the time at which the next message can be taken. A throttled
+    # background message can't be taken before its deadline or before the
+    # background traffic may resume, whichever is later.
+
+    def next_ready(self, now):
+        if not self.throttling(now) or self.available(now) >= 1:
+            return min(m['deadline'] for m in self.messages.values())
+        resume = self.interactive + self.window
+        if self.rate > 0:
+            resume = min(resume, now + (1 - self.available(now)) / self.rate)
+        ready = None
+        for message in self.messages.values():
+            deadline = message['deadline']
+            if message['rank'] == BACKGROUND:
+                deadline = max(deadline, resume)
+            if ready is None or deadline < ready:
+                ready = deadline
+        return ready
+
+    def throttling(self, now):
+        return self.interactive is not None and \
+            now - self.interactive < self.window
+
+    def available(self, now):
+        if self.refilled is None:
+            return self.rate
+        return min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+
+    # Remove the messages that are due and return them, at most limit of
+    # them, in order of priority and then of when they were first queued.
+    # While throttling, background messages are only taken as long as
+    # there are tokens for them; the rest stay queued.
+
+    def take_due(self, now, limit=FLUSH_BATCH):
+        due = [m for m in self.messages.values() if m['deadline'] <= now]
+        throttling = self.throttling(now)
+        if throttling:
+            due = self.throttle(due, now)
+        due = heapq.nsmallest(limit, due,
+                              key=lambda m: (m['rank'], m['first']))
+        if throttling:
+            self.tokens -= sum(1 for m in due if m['rank'] == BACKGROUND)
+        for message in due:
+            del self.messages[message['source']]
+            held = now - message['first']
+            message['held'] = held
+            self.stats['versions_out'] += 1
+            self.stats['coalesced'] += message['count'] - 1
+            self.stats['held_total'] += held
+            self.stats['held_max'] = max(self.stats['held_max'], held)
+        return due
+
+    def throttle(self, due, now):
+        self.tokens = self.available(now)
+        self.refilled = now
+        taken = [m for m in due if m['rank'] < BACKGROUND]
+        waiting = [m for m in due if m['rank'] == BACKGROUND]
+        allowed = min(len(waiting), max(0, int(self.tokens)))
+        if allowed:
+            waiting.sort(key=lambda m: m['first'])
+        for message in waiting[allowed:]:
+            if not message.get('throttled'):
+                message['throttled'] = True
+                self.stats['throttled'] += 1
+        return taken + waiting[:allowed]
+
+# Update the broker's documents from a version message and queue it as the
+# latest message for its source. Only the header is decoded, full contents
+# are kept as they came. The queued message contains the latest header,
+# the revision of the source that was last published as 'base', and the
+# edits that have been made since then (None if full contents have been
+# received). Returns the reply for the source.
+
+# A version that is identical to the last one that was published for its
+# source (see is_duplicate) isn't queued, so servers don't see it again.
+# The document just takes on its revision. Such versions are counted in the
+# 'duplicates' stat of the scheduler.
+
+
+def receive_version(frames, documents, scheduler, stats, tap):
+    # print('broker: got fromsources->toservers: {0!s}'.format(frames))
+    tap.send_multipart([source_topic()] + frames, copy=False)
+    header = decode_header(frames)
+    trace_hop(header, 'broker')
+    stats.version_in(header['source'], frames)
+    if is_legacy(frames, header):
+        frames = encode_version(header)
+        header = decode_header(frames)
+    source = header['source']
+    revision = header.get('revision')
+    document = documents.get(source)
+    base = header.get('base', revision)
+    if len(frames) == 1 and (document is None or document.revision != base):
+        return RESYNC
+    if is_duplicate(document, header, frames, scheduler):
+        document.revision = revision
+        scheduler.stats['duplicates'] += 1
+        return ACK
+    if document is None or document.published is None:
+        base = None
+    else:
+        base = document.published.get('revision')
+    if len(frames) > 1:
+        published = document.published if document else None
+        document = Document(revision, data=frames[1], hash=header.get('hash'))
+        document.published = published
+        documents[source] = document
+        edits = None
+    else:
+        edits = header.get('edits', [])
+        if edits:
+            document.apply(edits, revision)
+    message = scheduler.queue(source, time.monotonic(),
+                              header.get('priority'))
+    if message['count'] == 1:
+        message['base'] = base
+        message['edits'] = []
+    if edits is None or message['edits'] is None:
+        message['edits'] = None
+    else:
+        message['edits'].extend(edits)
+    message['header'] = header
+    # print('broker: message for {0} queued'.format(source))
+    return ACK
+
+# Return True if a version message has the same contents, language and
+# selections as the last version that was published for its source and
+# there is no other version of the source waiting to be published. Headers
+# with edits are never duplicates, since checking them would mean hashing
+# the whole document.
+
+
+def is_duplicate(document, header, frames, scheduler):
+    if document is None or document.published is None or \
+            header['source'] in scheduler.messages:
+        return False
+    published = document.published
+    if len(frames) > 1:
+        hash = header.get('hash') or content_hash(frames[1])
+    elif header.get('edits'):
+        return False
+    else:
+        hash = published['hash']
+    return hash == published['hash'] and \
+        header.get('language') == published.get('language') and \
+        header.get('selections') == published.get('selections')
+
+# Publish the full version and the delta for a queued message. Returns
+# the header of the delta.
+
+
+def flush_version(socket, document, message, stats):
+    header = dict(message['header'])
+    header.pop('base', None)
+    header.pop('edits', None)
+    header['revision'] = document.revision
+    header['hash'] = document.hash()
+    header['coalesced'] = message['count']
+    header['held'] = round(message['held'] * 1000)
+    if message['rank'] != NORMAL:
+        header['priority'] = PRIORITY_NAMES[message['rank']]
+    else:
+        header.pop('priority', None)
+    trace_hop(header, 'flush')
+    language = header['language']
+    source = header['source']
+    socket.send_multipart([version_topic(language, source),
+                           encode_header(header), document.data()],
+                          copy=False)
+    document.published = header
+    stats.version_out(message, document.data())
+    topic = delta_topic(language, source)
+    if message['edits'] is None:
+        socket.send_multipart([topic, encode_header(header), document.data()],
+                              copy=False)
+    else:
+        header['base'] = message['base']
+        header['edits'] = message['edits']
+        socket.send_multipart([topic, encode_header(header)])
+    return header
+
+# Publish the products in a message from a server to the sinks and
+# remember them in the product cache. Splices of columnar products are
+# published as they are, but applied to the cached table so that sinks
+# that ask for it get the whole table (see Columnar products). If the
+# cache doesn't have the table that a splice applies to, the product is
+# dropped from the cache until a whole table arrives. A splice for a
+# product that is waiting to be sent to the sinks (see SinkPublisher) would
+# replace the table that it applies to, so the whole table is sent instead.
+# If forward is given, it is called with the frames of the products that
+# weren't forwarded from another broker, marked as forwarded (see broker).
+
+
+def receive_products(frames, tosinks, products, stats, forward=None):
+    # print('broker: got fromservers->tosinks: {0!s}'.format(frames))
+    stats.products_in.mark(frames_size(frames))
+    forwarding = []
+    for product in split_products(frames):
+        header = decode_header(product)
+        topic = product_topic(header['product'], header['source'])
+        if 'trace' in header:
+            trace_hop(header, 'forward')
+            product = [encode_header(header)] + product[1:]
+        published = product
+        if 'splice' in header:
+            cache_splice(products, header, topic, product)
+            cached = products.find(header['source'], header['product'])
+            if cached is not None and topic in tosinks.waiting:
+                published = cached[1:]
+        else:
+            products.put(header['source'], header['product'],
+                         [topic] + product)
+        tosinks.publish(topic, published)
+        stats.product_out(header['product'], product)
+        if forward is not None and not header.get('forwarded'):
+            forwarding.append([encode_header(dict(header, forwarded=True))] +
+                              product[1:])
+    if forward is not None:
+        forward(forwarding)
+    return ACK
+
+
+def cache_splice(products, header, topic, frames):
+    cached = products.find(header['source'], header['product'])
+    whole = apply_splice(cached[1:] if cached else None, frames)
+    if whole is None:
+        products.discard(header['source'], header['product'])
+    else:
+        products.put(header['source'], header['product'], [topic] + whole)
+
+
+def frames_size(frames):
+    return sum(len(frame) for frame in frames)
+
+# Product caching
+
+# A ProductCache keeps the latest product for each pair of source and
+# product name, as the frames (topic, header and contents) that were
+# published for it. At most entries products are kept, taking at most size
+# bytes. When there are more, products are evicted according to eviction:
+# 'used' evicts the product that was least recently published or replayed
+# to a sink, 'updated' evicts the product that was least recently
+# published.
+
+
+class ProductCache:
+    def __init__(self, entries, size, eviction='used'):
+        if eviction not in ('used', 'updated'):
+            error('unknown eviction policy \'{0}\''.format(eviction))
+            sys.exit(3)
+        self.entries = entries
+        self.size = size
+        self.eviction = eviction
+        self.products = collections.OrderedDict()
+        self.stats = {
+            'replays': 0,
+            'replayed': 0,
+            'evictions': 0,
+            'entries': 0,
+            'bytes': 0
+        }
+
+    def put(self, source, product, frames):
+        key = (source, product)
+        size = sum(len(frame) for frame in frames)
+        if key in self.products:
+            self._remove(key)
+        if size > self.size:
+            return
+        self.products[key] = frames
+        self.stats['entries'] += 1
+        self.stats['bytes'] += size
+        while self.stats['entries'] > self.entries or \
+                self.stats['bytes'] > self.size:
+            self._remove(next(iter(self.products)))
+            self.stats['evictions'] += 1
+
+    # Return the frames of the cached product for source and product, or
+    # None if there isn't one. It doesn't count as a use. discard removes
+    # the product.
+
+    def find(self, source, product):
+        return self.products.get((source, product))
+
+    def discard(self, source, product):
+        if (source, product) in self.products:
+            self._remove((source, product))
+
+    # Return the frames of the cached products whose names pass the
+    # products filter and whose sources pass the sources filter (see
+    # matches), oldest first.
+
+    def get(self, products=None, sources=None):
+        keys = [key for key in self.products
+                if matches(sources, key[0]) and matches(products, key[1])]
+        if self.eviction == 'used':
+            for key in keys:
+                self.products.move_to_end(key)
+        self.stats['replays'] += 1
+        self.stats['replayed'] += len(keys)
+        return [self.products[key] for key in keys]
+
+    def _remove(self, key):
+        frames = self.products.pop(key)
+        self.stats['entries'] -= 1
+        self.stats['bytes'] -= sum(len(frame) for frame in frames)
+
+# Reply to a request from a sink for cached products. The request is a
+# JSON header with optional 'products' and 'sources' filters. The reply is
+# the routed frames of each matching product, one after the other, or
+# just an empty frame if there aren't any. Each routed product is
+# preceded by a frame with the number of frames that follow for it.
+
+
+def replay_products(frames, products):
+    request = decode_header(frames) if frames and frames[0] else {}
+    reply = []
+    for product in products.get(request.get('products'),
+                                request.get('sources')):
+        reply.append(str(len(product)).encode())
+        reply.extend(product)
+    return reply or [b'']
+
+# Server groups
+
+# Servers that join a group (see server) are sent each version by the
+# broker instead of subscribing to all of them, so that a group of
+# replicas of an expensive server share the work instead of each doing
+# all of it. Each member of a group sends a heartbeat to the groups socket
+# of the broker every HEARTBEAT milliseconds (and whenever it finishes a
+# version), with the 'group' and the id of the 'replica', the 'languages'
+# that it wants, whether it wants 'deltas', whether it is 'ready' and the
+# source and revision of each version that it is 'done' with. A member is
+# ready once it has received the broker's welcome, which the broker sends
+# in reply to the heartbeats of new members, so that no versions are sent
+# before the member's subscriptions have reached the broker.
+
+# The broker sends each version to one member of each group that wants
+# its language: the member that got the last version of its source, so
+# that any state that it keeps for the source stays useful, unless that
+# member has more than AFFINITY_SLACK more versions in flight than the
+# least loaded member, in which case the least loaded member gets it. A
+# member that leaves or that misses LIVENESS heartbeats in a row is
+# removed, and the versions that it had in flight are sent to the other
+# members. HEARTBEAT and LIVENESS are the 'heartbeat' and 'liveness'
+# settings of the 'broker' section of .monto.
+
+AFFINITY_SLACK = 2
+
+
+class ServerGroups:
+    def __init__(self, heartbeat, liveness):
+        self.expiry = heartbeat / 1000 * liveness
+        self.groups = {}
+        self.stats = {
+            'joined': 0,
+            'left': 0,
+            'expired': 0,
+            'dispatched': 0,
+            'reassigned': 0
+        }
+
+    # Update the member that sent a heartbeat. Returns a pair of the member
+    # (None if it has left) and the pairs of group and source of the
+    # versions that it had in flight if it has left.
+
+    def beat(self, header, now):
+        name = header['group']
+        group = self.groups.get(name)
+        if group is None:
+            group = ServerGroup(self.stats)
+            self.groups[name] = group
+        replica = group.replicas.get(header['replica'])
+        if header.get('leaving'):
+            if replica is None:
+                return (None, [])
+            self.stats['left'] += 1
+            return (None, group.remove(replica))
+        if replica is None:
+            replica = Replica(header)
+            group.replicas[replica.id] = replica
+            self.stats['joined'] += 1
+        replica.beat(header, now)
+        return (replica, [])
+
+    # Remove the members that haven't sent a heartbeat for too long and
+    # return the pairs of group and source of their versions in flight.
+
+    def expire(self, now):
+        orphans = []
+        for group in self.groups.values():
+            for replica in list(group.replicas.values()):
+                if now - replica.seen > self.expiry:
+                    self.stats['expired'] += 1
+                    orphans.extend(group.remove(replica))
+        return orphans
+
+    # Return the number of milliseconds until the next member expires, or
+    # None if there are no members.
+
+    def timeout(self, now):
+        seen = [replica.seen for group in self.groups.values()
+                for replica in group.replicas.values()]
+        if seen:
+            return max(0, (min(seen) + self.expiry - now) * 1000)
+        else:
+            return None
+
+    def snapshot(self):
+        snapshot = dict(self.stats)
+        snapshot['groups'] = {
+            name: {
+                'replicas': len(group.replicas),
+                'in_flight': sum(len(replica.inflight)
+                                 for replica in group.replicas.values())
+            }
+            for name, group in self.groups.items()
+        }
+        return snapshot
+
+
+class ServerGroup:
+    def __init__(self, stats):
+        self.replicas = {}
+        self.affinity = {}
+        self.stats = stats
+
+    # Choose the member that a version of source in language is sent to,
+    # or return None if no member wants it.
+
+    def assign(self, source, language):
+        candidates = [replica for replica in self.replicas.values()
+                      if replica.ready and matches(replica.languages,
+                                                   language)]
+        if not candidates:
+            return None
+        least = min(candidates, key=lambda replica: (len(replica.inflight),
+                                                     len(replica.revisions)))
+        replica = self.replicas.get(self.affinity.get(source))
+        if replica not in candidates or \
+                len(replica.inflight) > len(least.inflight) + AFFINITY_SLACK:
+            replica = least
+        self.affinity[source] = replica.id
+        self.stats['dispatched'] += 1
+        return replica
+
+    def remove(self, replica):
+        del self.replicas[replica.id]
+        return [(self, source) for source in replica.inflight]
+
+# A Replica is the broker's view of a member of a group: the versions that
+# it has in flight and the revision of each source that it was sent last.
+
+
+class Replica:
+    def __init__(self, header):
+        self.id = header['replica']
+        self.topic = replica_topic(self.id)
+        self.languages = header.get('languages')
+        self.deltas = header.get('deltas', False)
+        self.ready = False
+        self.seen = None
+        self.inflight = {}
+        self.revisions = {}
+
+    def beat(self, header, now):
+        self.seen = now
+        self.ready = header.get('ready', False)
+        for (source, revision) in header.get('done', []):
+            if self.inflight.get(source) == revision:
+                del self.inflight[source]
+
+    def sent(self, source, revision):
+        self.inflight[source] = revision
+        self.revisions[source] = revision
+
+# Send a published version (see flush_version) to a member of a group. A
+# member that wants deltas is sent the edits if it was sent the base
+# revision of the source last, and the full contents otherwise. The full
+# version is sent as well, but only reaches it if it has asked for full
+# versions of the source (see receive_delta).
+
+
+def publish_replica(socket, replica, document, header):
+    full = dict(header)
+    base = full.pop('base', None)
+    edits = full.pop('edits', None)
+    language = header['language']
+    source = header['source']
+    frames = [encode_header(full), document.data()]
+    if replica.deltas:
+        topic = replica.topic + delta_topic(language, source)
+        if edits is not None and base is not None and \
+                replica.revisions.get(source) == base:
+            socket.send_multipart([topic, encode_header(header)])
+        else:
+            socket.send_multipart([topic] + frames, copy=False)
+    socket.send_multipart([replica.topic + version_topic(language, source)] +
+                          frames, copy=False)
+    replica.sent(source, header['revision'])
+
+# Broker statistics
+
+# A BrokerStats counts the versions that the broker receives and publishes,
+# the product messages that it receives and the products that it
+# publishes, both overall and for each source and product name. Each count
+# is kept by a Meter, which also keeps the number of bytes and the rates
+# over the last RATE_WINDOW seconds. Histograms record the time that
+# versions were held and the time that each phase of the broker loop took:
+# 'wait' (waiting for messages), 'sources', 'publish', 'servers', 'sinks'
+# and 'stats', 'groups' for the heartbeats of server groups, 'forward'
+# for replies from brokers that versions are forwarded to and 'retry' for
+# products that are waiting for sinks (see SinkPublisher). A threaded
+# broker has a BrokerStats for each path, and records 'wait versions' and
+# 'wait products' instead of 'wait' and 'stats'.
+
+RATE_WINDOW = 10
+
+
+class BrokerStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.versions_in = Meter()
+        self.versions_out = Meter()
+        self.products_in = Meter()
+        self.products_out = Meter()
+        self.sources = collections.defaultdict(Meter)
+        self.products = collections.defaultdict(Meter)
+        self.held = Histogram()
+        self.phases = collections.defaultdict(Histogram)
+
+    def version_in(self, source, frames):
+        size = frames_size(frames)
+        self.versions_in.mark(size)
+        self.sources[source].mark(size)
+
+    def version_out(self, message, data):
+        self.versions_out.mark(len(data))
+        self.held.add(message['held'])
+
+    def product_out(self, name, frames):
+        size = frames_size(frames)
+        self.products_out.mark(size)
+        self.products[name].mark(size)
+
+    # Record the time since start (from time.perf_counter) for a phase and
+    # return the current time.
+
+    def phase(self, name, start):
+        now = time.perf_counter()
+        self.phases[name].add(now - start)
+        return now
+
+    # Return the statistics of each path as a dict that can be sent as
+    # JSON. Both include the phases.
+
+    def version_snapshot(self):
+        now = time.monotonic()
+        return {
+            'versions_in': self.versions_in.snapshot(now),
+            'versions_out': self.versions_out.snapshot(now),
+            'sources': {source: meter.snapshot(now)
+                        for source, meter in self.sources.items()},
+            'held': self.held.snapshot(),
+            'phases': self.phases_snapshot()
+        }
+
+    def product_snapshot(self):
+        now = time.monotonic()
+        return {
+            'products_in': self.products_in.snapshot(now),
+            'products_out': self.products_out.snapshot(now),
+            'products': {name: meter.snapshot(now)
+                         for name, meter in self.products.items()},
+            'phases': self.phases_snapshot()
+        }
+
+    def phases_snapshot(self):
+        return {name: histogram.snapshot()
+                for name, histogram in self.phases.items()}
+
+
+class Meter:
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.recent = collections.deque()
+
+    def mark(self, size):
+        self.count += 1
+        self.bytes += size
+        second = int(time.monotonic())
+        if self.recent and self.recent[-1][0] == second:
+            self.recent[-1][1] += 1
+            self.recent[-1][2] += size
+        else:
+            self.recent.append([second, 1, size])
+            while self.recent[0][0] <= second - RATE_WINDOW:
+                self.recent.popleft()
+
+    def snapshot(self, now):
+        recent = [b for b in self.recent if b[0] > now - RATE_WINDOW]
+        return {
+            'count': self.count,
+            'bytes': self.bytes,
+            'rate': sum(b[1] for b in recent) / RATE_WINDOW,
+            'byte_rate': sum(b[2] for b in recent) / RATE_WINDOW
+        }
+
+# A Histogram counts times, given in seconds, in buckets whose upper
+# bounds are HISTOGRAM_BOUNDS milliseconds. The last bucket, with a bound
+# of None, counts the longer times.
+
+HISTOGRAM_BOUNDS = [0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS, ms)] += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def snapshot(self):
+        count = sum(self.counts)
+        return {
+            'count': count,
+            'total': self.total,
+            'mean': self.total / count if count else 0.0,
+            'max': self.max,
+            'buckets': list(zip(HISTOGRAM_BOUNDS + [None], self.counts))
+        }
+
+# Ask the broker for its statistics. Returns None if the broker doesn't
+# reply within timeout milliseconds (e.g., because it doesn't keep any).
+# address is the stats address of the broker, by default that of the first
+# shard.
+
+
+def request_stats(timeout=1000, address=None):
+    context = zmq.Context()
+    tostats = context.socket(zmq.REQ)
+    tostats.setsockopt(zmq.LINGER, 0)
+    connect(tostats, address or SHARDS[0]['stats'])
+    tostats.send(b'')
+    if tostats.poll(timeout):
+        stats = decode_header(tostats.recv_multipart())
+    else:
+        stats = None
+    tostats.close()
+    context.term()
+    return stats
+
+# Recording
+
+# Traffic can be recorded in a log file (see record.py and replay.py). Each
+# record in the log is a line with the time in seconds since the recording
+# started, the stream that the message was seen on ('source', 'version' or
+# 'product') and the length in bytes of each of the message frames (without
+# the routing topic), separated by spaces, followed by the frames
+# themselves. Logs whose names end in '.gz' are compressed with gzip.
+
+
+def open_log(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 'b')
+    else:
+        return open(filename, mode + 'b')
+
+
+def write_record(file, when, stream, frames):
+    lengths = ' '.join(str(len(frame)) for frame in frames)
+    file.write('{0:.6f} {1} {2}\n'.format(when, stream, lengths).encode())
+    for frame in frames:
+        file.write(frame)
+
+# Return the records in a log as triples of time, stream and frames.
+
+
+def read_records(file):
+    while True:
+        line = file.readline()
+        if not line:
+            return
+        fields = line.decode().split()
+        frames = [file.read(int(length)) for length in fields[2:]]
+        yield (float(fields[0]), fields[1], frames)
+
+# server
+
+# General handler for writing Monto servers. Every time a version comes in
+# server calls func with the contents of the version message as a JSON value.
+# func should return a quadruple that contains the name of a product, the
+# language that the product is in, the content of the product, and a
+# continuation flag. The product, language and content are used to send
+# a product. If the continuation flag is True then the server waits for
+# another version, otheriwse it returns. If filter is set, this server only
+# sends product for versions that have a matching language. filter can be
+# a single language or a list of languages. The filter is applied by
+# subscription so versions in other languages are never received.
+
+# If deltas is True, the server receives deltas instead of full versions
+# and keeps its own copy of the documents. The version passed to func
+# still has the full 'contents', but also has the 'edits' that were made
+# since the last version of the same source that func saw and the 'base'
+# revision they apply to. 'edits' is None if the contents were replaced as
+# a whole, or if the server missed a delta. In the latter case the server
+# catches up from the next full version of that source.
+
+# If a server falls behind, versions queue up for it. Unless conflate is
+# False, the server reads all of the versions that are waiting each time
+# it is ready for more and only processes the newest one for each source
+# (combining the edits of deltas). The number of versions that were
+# skipped is kept in the skipped field of the VersionReader.
+
+# If workers is set, versions are processed by a pool of that many
+# processes so that slow versions of one source don't hold up the others
+# (see serve_pool). func must then be picklable, i.e., defined at the top
+# level of a module. If report is set, it is called with a dict that
+# describes each version that has been processed: its 'source' and
+# 'revision', the time in seconds that it 'waited' before processing
+# started, the time that func 'ran' for, the number of 'products', and
+# the number of older versions of the source that were 'skipped' in
+# favour of it.
+
+# If cache is set to a ResultCache, the products that func returns for a
+# version are remembered and sent again without calling func if an
+# identical version arrives later (see ResultCache). The report for such a
+# version has 'cached' set to True.
+
+# hooks is a list of functions that are wrapped around each call of func
+# (see Hooks). With workers, they must be picklable as well.
+
+# If data is True, the 'contents' of the version passed to func are the
+# UTF-8 bytes as they were received (a bytes-like object, often a
+# memoryview of the message) rather than a string, so a server that only
+# needs bytes doesn't pay for decoding large contents.
+
+# If group is set, the server joins the server group of that name (see
+# Server groups) and only gets the versions that the broker gives it
+# rather than all of them, so that several copies of the server can share
+# the work.
+
+# If consumes is set to a product name or a list of them, the server is a
+# stage of a pipeline that gets those products of other servers along with
+# each version (see Product pipelines).
+
+
+def server(func, filter=None, deltas=False, workers=None, report=None,
+           conflate=True, cache=None, hooks=(), data=False, group=None,
+           consumes=None):
+    context = zmq.Context()
+    toservers = context.socket(zmq.SUB)
+    connect_all(toservers, 'to_servers')
+    member = GroupMember(group, filter, deltas) if group else None
+    reader = VersionReader(toservers, filter, deltas, conflate, data, member)
+    fromservers = Shards(context, from_servers())
+    inputs = ProductInputs(context, consumes) if consumes else None
+    if member is not None:
+        report = member.reporter(report)
+    try:
+        if workers:
+            serve_pool(func, toservers, reader, fromservers, workers, report,
+                       cache, hooks, inputs)
+        else:
+            serve_versions(func, toservers, reader, fromservers, report,
+                           cache, hooks, inputs)
+    finally:
+        if member is not None:
+            member.close()
+
+
+def serve_versions(func, toservers, reader, fromservers, report, cache,
+                   hooks, inputs=None):
+    while True:
+        # print('server: waiting for version')
+        for (version, skipped) in read_versions(toservers, reader, inputs):
+            # print('server: got version {0!s}'.format(version))
+            result = stored_result(cache, inputs, version)
+            if result is None:
+                trace_hop(version, 'call')
+                ((products, contflag), ran) = timed_call(func, version, hooks)
+                trace_hop(version, 'return')
+                # print('server: func produced {0!s}'.format(products))
+                result = cache_result(cache, version, products, contflag)
+            else:
+                trace_hop(version, 'cached')
+                ran = None
+            (frames, contflag) = result
+            if inputs is not None:
+                inputs.remember(version, frames)
+            if report:
+                report(job_report(version, 0, ran, frames, skipped))
+            if frames:
+                respond_frames(fromservers, traced_frames(version, frames))
+            if not (contflag):
+                fromservers.flush()
+                return
+
+# Wait for versions and return the pairs of version and number of skipped
+# versions that are ready to be processed.
+
+
+def read_versions(toservers, reader, inputs):
+    if inputs is not None:
+        return inputs.read(toservers, reader)
+    versions = reader.read_latest(recv_routed(toservers))
+    for (version, _) in versions:
+        trace_hop(version, 'server')
+    return versions
+
+# Call func with version and return its result and how long it took.
+
+
+def timed_call(func, version, hooks=()):
+    start = time.perf_counter()
+    result = hooked_call(func, version, hooks)
+    return (result, time.perf_counter() - start)
+
+
+# Make the report about a version. ran is None if the result came from the
+# cache, frames are the encoded products.
+
+
+def job_report(version, waited, ran, frames, skipped):
+    return {
+        'source': version['source'],
+        'revision': version.get('revision'),
+        'waited': waited,
+        'ran': ran or 0,
+        'products': len(frames) // 2,
+        'skipped': skipped,
+        'cached': ran is None
+    }
+
+# Hooks
+
+# A hook is called with a version and a function of no arguments that
+# calls the server function (and the hooks after this one) and returns its
+# result. It returns that result, so it can do things before and after the
+# call, such as timing or profiling it.
+
+
+def hooked_call(func, version, hooks):
+    if not hooks:
+        return func(version)
+    return hooks[0](version, lambda: hooked_call(func, version, hooks[1:]))
+
+# A hook that reports calls that take at least threshold seconds.
+
+
+class SlowCallHook:
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def __call__(self, version, call):
+        start = time.perf_counter()
+        try:
+            return call()
+        finally:
+            ran = time.perf_counter() - start
+            if ran >= self.threshold:
+                error('slow call for {0} revision {1}: {2:.3f}s'.format(
+                    version['source'], version.get('revision'), ran))
+
+# A hook that profiles a sample fraction of calls with cProfile and writes
+# the profiles of the ones that take at least threshold seconds to files in
+# directory, named after the source, revision and time. They can be read
+# with the pstats module or tools such as snakeviz.
+
+
+class ProfileHook:
+    def __init__(self, directory, threshold=0.1, sample=1.0):
+        self.directory = directory
+        self.threshold = threshold
+        self.sample = sample
+
+    def __call__(self, version, call):
+        if random.random() >= self.sample:
+            return call()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            return call()
+        finally:
+            profile.disable()
+            if time.perf_counter() - start >= self.threshold:
+                name = '{0}-{1}-{2}.prof'.format(
+                    os.path.basename(version['source']) or 'source',
+                    version.get('revision'), int(time.time() * 1000))
+                profile.dump_stats(os.path.join(self.directory, name))
+
+# Result caching
+
+# A ResultCache remembers the products that a server produced for recent
+# versions. Versions are identical if they have the same source, language,
+# contents hash and selections. At most entries results are kept, taking at
+# most size bytes of encoded products. The least recently used results are
+# evicted first. The cache works on whole results, since func makes all of
+# the products for a version in one call: a server can stop a result from
+# being cached by including a product with a 'cache_result' field that is
+# False, and then none of the products for that version are cached. The
+# field is removed before the product is sent. Results that stop the
+# server are never cached, and neither are splices of columnar products
+# (see Columnar products), since by the time they are sent again their
+# base table is out of date.
+
+# Note that a server that receives deltas isn't called for a cached
+# version, so it won't see the edits of that version.
+
+
+class ResultCache:
+    def __init__(self, entries=256, size=64 * 1024 * 1024):
+        self.entries = entries
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'entries': 0,
+            'bytes': 0
+        }
+
+    def key(self, version):
+        hash = version.get('hash')
+        if hash is None:
+            hash = content_hash(contents_data(version['contents']))
+        selections = tuple((s['begin'], s['end'])
+                           for s in version.get('selections', []))
+        return (version['source'], version['language'], hash, selections)
+
+    # Return the cached result for version as a pair of the encoded products
+    # and the continuation flag, or None if there isn't one.
+
+    def get(self, version):
+        key = self.key(version)
+        if key in self.results:
+            self.results.move_to_end(key)
+            self.stats['hits'] += 1
+            return (self.results[key], True)
+        else:
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, version, frames):
+        key = self.key(version)
+        size = sum(len(frame) for frame in frames)
+        if size > self.size:
+            return
+        if key in self.results:
+            self._remove(key)
+        self.results[key] = frames
+        self.stats['entries'] += 1
+        self.stats['bytes'] += size
+        while self.stats['entries'] > self.entries or \
+                self.stats['bytes'] > self.size:
+            self._remove(next(iter(self.results)))
+            self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        frames = self.results.pop(key)
+        self.stats['entries'] -= 1
+        self.stats['bytes'] -= sum(len(frame) for frame in frames)
+
+# Encode the products that func returned for a version and cache them if
+# there is a cache and they can be cached. Returns a pair of the encoded
+# products and the continuation flag.
+
+
+def cache_result(cache, version, products, contflag):
+    cacheable = contflag and all(product.get('cache_result', True) and
+                                 not is_splice(product['contents'])
+                                 for product in products)
+    frames = encode_products([stamp_product(version, product)
+                              for product in products])
+    if cache is not None and cacheable:
+        cache.put(version, frames)
+    return (frames, contflag)
+
+
+def strip_cacheable(product):
+    if 'cache_result' in product:
+        product = dict(product)
+        del product['cache_result']
+    return product
+
+# Give a product the 'version_hash' of the version that it was made from
+# (see Product pipelines), unless it already has one.
+
+
+def stamp_product(version, product):
+    product = strip_cacheable(product)
+    if 'hash' in version and 'version_hash' not in product:
+        product = dict(product, version_hash=version['hash'])
+    return product
+
+# Product pipelines
+
+# A server can consume the products of other servers, e.g., to build an
+# outline from the tokens that another server has found instead of
+# tokenizing the contents again. A server that is called with consumes
+# set to a product name or a list of them subscribes to those products on
+# the broker's to_sinks socket as well as to versions. Each version is
+# passed to func once a product of every consumed name has arrived for it,
+# with the products (decoded, by name) in its 'products' field. Each
+# consumed product also has the 'hash' of its contents. Servers that
+# consume each other's products form a pipeline in which each stage runs
+# as soon as the stages before it are done for a version.
+
+# Servers give each product the 'version_hash' of the version that it was
+# made from (see stamp_product), which is how a stage knows which version
+# a product belongs to. A version that is waiting for products is dropped
+# in favour of a newer version of its source (combining their edits for
+# deltas), so stale stages never run. A stage is taken to derive its
+# products from the consumed products and the language and selections of
+# the version, not from the contents. If none of those have changed since
+# func was last called for the source, e.g., after an edit inside a
+# comment that doesn't change the tokens, the previous products are sent
+# again for the new version without calling func. As with the result
+# cache, a stage that receives deltas doesn't see the edits of such a
+# version.
 
-# Default addresses, can be overridden in .monto
-FROMSOURCES_DEFAULT = b'tcp://127.0.0.1:5000'
-TOSERVERS_DEFAULT = b'tcp://127.0.0.1:5001'
-FROMSERVERS_DEFAULT = b'tcp://127.0.0.1:5002'
-TOSINKS_DEFAULT = b'tcp://127.0.0.1:5003'
+# Stages must not form a cycle, and a stage should have the same language
+# filter as the servers that it consumes from, since it waits for their
+# products.
 
-# Configuration file reading
+# A ProductInputs holds the latest consumed products of each source, the
+# versions that are waiting for products and the inputs and products of
+# the last call of func for each source. In the reports of the server,
+# reused products count as 'cached' and versions that were dropped while
+# waiting for products count as 'skipped'.
 
 
-def monto_config_file_path():
-    return pathlib.Path(os.path.expanduser('~/.monto'))
+class ProductInputs:
+    def __init__(self, context, consumes, limit=1000):
+        if isinstance(consumes, str):
+            consumes = [consumes]
+        self.consumes = list(consumes)
+        self.socket = context.socket(zmq.SUB)
+        connect_all(self.socket, 'to_sinks')
+        subscribe(self.socket, product_topic, self.consumes)
+        self.context = context
+        self.limit = limit
+        self.poller = None
+        self.tables = ColumnTables()
+        self.products = {}
+        self.pending = {}
+        self.last = {}
 
+    # Wait for versions on toservers (read by reader, see VersionReader)
+    # and for products, and return the pairs of version and number of
+    # skipped versions that are ready to be processed.
 
-def monto_read_config():
-    with monto_config_file_path().open('r') as file:
-        try:
-            return json.load(file)
-        except ValueError as err:
-            error('can\'t parse config file as JSON: {0!s}'.format(err))
-            sys.exit(3)
+    def read(self, toservers, reader):
+        if self.poller is None:
+            self.poller = zmq.Poller()
+            self.poller.register(toservers, zmq.POLLIN)
+            self.poller.register(self.socket, zmq.POLLIN)
+        ready = dict(self.poller.poll())
+        jobs = []
+        if ready.get(toservers) == zmq.POLLIN:
+            for (version, skipped) in \
+                    reader.read_latest(recv_routed(toservers)):
+                trace_hop(version, 'server')
+                jobs.extend(self.add_version(version, skipped))
+        if ready.get(self.socket) == zmq.POLLIN:
+            jobs.extend(self.read_products())
+        return jobs
 
-# Global configuration
-monto_config = monto_read_config()
+    # Take a version that has arrived. Returns a list with the version and
+    # the number of versions skipped for it if its products are there, or
+    # an empty list if it has to wait for them.
 
-# Setup communication addresses
+    def add_version(self, version, skipped):
+        source = version['source']
+        if source in self.pending:
+            (older, older_skipped) = self.pending.pop(source)
+            version = supersede_version(older, version)
+            skipped += older_skipped + 1
+        if self.complete(version):
+            return [(self.attach(version), skipped)]
+        self.pending[source] = (version, skipped)
+        return []
 
+    # Give back a version whose call of func was cancelled, so that its
+    # edits are combined with those of the version that is waiting.
 
-def monto_connection_or_default(name, default):
-    if 'connections' in monto_config:
-        connections = monto_config['connections']
-        return connections.get(name, default)
-    else:
-        return default
+    def restore(self, version):
+        source = version['source']
+        if source in self.pending:
+            (newer, skipped) = self.pending[source]
+            self.pending[source] = (supersede_version(version, newer),
+                                    skipped + 1)
 
-FROMSOURCES = monto_connection_or_default('from_sources', FROMSOURCES_DEFAULT)
-TOSERVERS = monto_connection_or_default('to_servers', TOSERVERS_DEFAULT)
-FROMSERVERS = monto_connection_or_default('from_servers', FROMSERVERS_DEFAULT)
-TOSINKS = monto_connection_or_default('to_sinks', TOSINKS_DEFAULT)
+    # Receive the products that are waiting, at most limit messages, and
+    # return the versions that they complete. Splices of columnar products
+    # whose base is missing are caught up from the broker (see
+    # ColumnTables).
 
-# broker
+    def read_products(self):
+        jobs = []
+        for _ in range(self.limit):
+            try:
+                message = recv_routed_noblock(self.socket)
+            except zmq.Again:
+                break
+            jobs.extend(self.add_products(*message))
+        for message in resync_tables(self.context, self.tables):
+            jobs.extend(self.add_products(*message))
+        return jobs
 
-# The Monto broker. Waits for versions to come in from sources. Each version
-# is published to the servers. Products from servers are published to the
-# sinks.
+    def add_products(self, topic, frames):
+        jobs = []
+        for product in split_products(frames):
+            message = self.tables.apply(topic, product)
+            if message is None:
+                continue
+            product = message[1]
+            header = decode_header(product)
+            if topic is None and not matches(self.consumes,
+                                             header['product']):
+                continue
+            source = header['source']
+            self.products[(source, header['product'])] = (header, product)
+            if source in self.pending and \
+                    self.complete(self.pending[source][0]):
+                (version, skipped) = self.pending.pop(source)
+                jobs.append((self.attach(version), skipped))
+        return jobs
 
+    def complete(self, version):
+        for name in self.consumes:
+            consumed = self.products.get((version['source'], name))
+            if consumed is None or \
+                    consumed[0].get('version_hash') != version.get('hash'):
+                return False
+        return True
+
+    def attach(self, version):
+        products = {}
+        for name in self.consumes:
+            (_, frames) = self.products[(version['source'], name)]
+            product = decode_product(frames)
+            product['hash'] = content_hash(contents_data(frames[1])) \
+                if len(frames) > 1 else None
+            products[name] = product
+        version['products'] = products
+        return version
+
+    # Return the previous result for the source of version as a pair of
+    # encoded products and continuation flag if func was last called with
+    # the same inputs, otherwise None. remember records the products that
+    # func made for a version.
+
+    def reuse(self, version):
+        last = self.last.get(version['source'])
+        if last is None or last[0] != self.inputs(version):
+            return None
+        return (restamp_frames(last[1], version), True)
+
+    def remember(self, version, frames):
+        if any('splice' in decode_header(frames[i:i + 2])
+               for i in range(0, len(frames), 2)):
+            self.last.pop(version['source'], None)
+        else:
+            self.last[version['source']] = (self.inputs(version), frames)
+
+    def inputs(self, version):
+        selections = tuple((s['begin'], s['end'])
+                           for s in version.get('selections', []))
+        return (version['language'], selections,
+                tuple(version['products'][name]['hash']
+                      for name in self.consumes))
+
+    def close(self):
+        self.socket.close()
+
+# Give encoded products that are sent again for version its hash. Splices
+# are never sent again (see remember).
+
+
+def restamp_frames(frames, version):
+    stamped = []
+    for i in range(0, len(frames), 2):
+        header = decode_header(frames[i:i + 2])
+        header['version_hash'] = version.get('hash')
+        stamped.append(encode_header(header))
+        stamped.extend(frames[i + 1:i + 2])
+    return stamped
+
+# Return the result for a version that the cache or the product inputs of
+# a pipeline stage already have, or None if func has to be called.
+
+
+def stored_result(cache, inputs, version):
+    result = cache.get(version) if cache else None
+    if result is None and inputs is not None:
+        result = inputs.reuse(version)
+    return result
+
+# Versions are pickled to be sent to worker processes, which memoryviews
+# can't be, so contents that are memoryviews (see recv_frames), including
+# the columns of the products that a pipeline stage consumes, are copied.
 
-def broker():
-    context = zmq.Context()
-    fromsources = context.socket(zmq.REP)
-    fromsources.bind(FROMSOURCES)
-    toservers = context.socket(zmq.PUB)
-    toservers.bind(TOSERVERS)
-    fromservers = context.socket(zmq.REP)
-    fromservers.bind(FROMSERVERS)
-    tosinks = context.socket(zmq.PUB)
-    tosinks.bind(TOSINKS)
 
+def picklable_version(version):
+    if isinstance(version.get('contents'), memoryview):
+        version = dict(version, contents=bytes(version['contents']))
+    if 'products' in version:
+        version = dict(version, products={
+            name: picklable_product(product)
+            for (name, product) in version['products'].items()})
+    return version
+
+
+def picklable_product(product):
+    contents = product.get('contents')
+    if isinstance(contents, memoryview):
+        return dict(product, contents=bytes(contents))
+    if isinstance(contents, Columns) and \
+            isinstance(contents.data, memoryview):
+        return dict(product, contents=Columns(
+            contents.columns, contents.rows, bytes(contents.data),
+            contents.symbols, contents.relative, contents.table,
+            contents.splice))
+    return product
+
+# Server loop for a pool of worker processes. At most one version of each
+# source is processed at a time. The newest version that arrives while
+# its source is being processed waits for it to finish (as in
+# async_server). Products are sent in the order in which versions are
+# finished. The pool signals that a version is finished by writing to a
+# pipe that is polled along with the socket.
+
+
+def serve_pool(func, toservers, reader, fromservers, workers, report,
+               cache, hooks, inputs=None):
+    (finished_in, finished_out) = os.pipe()
     poller = zmq.Poller()
-    poller.register(fromsources, zmq.POLLIN)
-    poller.register(fromservers, zmq.POLLIN)
+    poller.register(toservers, zmq.POLLIN)
+    poller.register(finished_in, zmq.POLLIN)
+    if inputs is not None:
+        poller.register(inputs.socket, zmq.POLLIN)
+    pool = concurrent.futures.ProcessPoolExecutor(workers)
+    running = {}
+    waiting = {}
 
-    messages = {}
+    def start(version, received, skipped):
+        result = stored_result(cache, inputs, version)
+        if result is not None:
+            trace_hop(version, 'cached')
+            (frames, contflag) = result
+            if inputs is not None:
+                inputs.remember(version, frames)
+            if report:
+                report(job_report(version, time.monotonic() - received, None,
+                                  frames, skipped))
+            if frames:
+                respond_frames(fromservers, traced_frames(version, frames))
+            return contflag
+        trace_hop(version, 'call')
+        version = picklable_version(version)
+        future = pool.submit(timed_call, func, version, hooks)
+        future.add_done_callback(lambda f: os.write(finished_out, b'.'))
+        running[version['source']] = {
+            'future': future,
+            'version': version,
+            'waited': time.monotonic() - received,
+            'skipped': skipped
+        }
+        return True
 
-    while True:
-        # print('broker: waiting')
-        ready = dict(poller.poll(500))
-        if ready.get(fromsources) == zmq.POLLIN:
-            message = fromsources.recv()
-            # print('broker: got fromsources->toservers: {0!s}'
-            #       .format(message))
-            fromsources.send(b'ack')
-            # print('broker: sent ack to source')
-            # Queue this message as the latest for its source
-            version = json.loads(message.decode())
-            source = version['source']
-            messages[source] = message
-            # print('broker: message for {0} queued'.format(source))
-        else:
-            # Send any messages we have queued up
-            # print('broker: sending {0!s} messages'.format(len(messages)))
-            for message in messages.values():
-                toservers.send(message)
-            messages = {}
-        if ready.get(fromservers) == zmq.POLLIN:
-            message = fromservers.recv()
-            # print('broker: got fromservers->tosinks: {0!s}'.format(message))
-            fromservers.send(b'ack')
-            # print('broker: sent ack to server')
-            tosinks.send(message)
-            # print('broker: sent product to sinks')
+    # Start a version that is ready to be processed, or make it wait for
+    # the version of its source that is running. Returns False if the
+    # server should stop.
 
-# server
+    def arrive(version, received, skipped):
+        source = version['source']
+        if source not in running:
+            return start(version, received, skipped)
+        elif source in waiting:
+            (older, _, older_skipped) = waiting[source]
+            version = supersede_version(older, version)
+            skipped += older_skipped + 1
+            reader.skipped += 1
+            waiting[source] = (version, received, skipped)
+        else:
+            waiting[source] = (version, received, skipped)
+        return True
 
-# General handler for writing Monto servers. Every time a version comes in
-# server calls func with the contents of the version message as a JSON value.
-# func should return a quadruple that contains the name of a product, the
-# language that the product is in, the content of the product, and a
-# continuation flag. The product, language and content are used to send
-# a product. If the continuation flag is True then the server waits for
-# another version, otheriwse it returns. If filter is set, this server only
-# sends product for versions that have a matching language.
+    try:
+        while True:
+            ready = dict(poller.poll())
+            now = time.monotonic()
+            jobs = []
+            if ready.get(toservers) == zmq.POLLIN:
+                message = recv_routed(toservers)
+                for (version, skipped) in reader.read_latest(message):
+                    trace_hop(version, 'server')
+                    if inputs is None:
+                        jobs.append((version, skipped))
+                    else:
+                        jobs.extend(inputs.add_version(version, skipped))
+            if inputs is not None and \
+                    ready.get(inputs.socket) == zmq.POLLIN:
+                jobs.extend(inputs.read_products())
+            for (version, skipped) in jobs:
+                if not arrive(version, now, skipped):
+                    fromservers.flush()
+                    return
+            if ready.get(finished_in) == zmq.POLLIN:
+                os.read(finished_in, 4096)
+                for source, job in list(running.items()):
+                    if job['future'].done():
+                        del running[source]
+                        ((products, contflag), ran) = job['future'].result()
+                        trace_hop(job['version'], 'return')
+                        (frames, contflag) = cache_result(
+                            cache, job['version'], products, contflag)
+                        if inputs is not None:
+                            inputs.remember(job['version'], frames)
+                        if report:
+                            report(job_report(job['version'], job['waited'],
+                                              ran, frames, job['skipped']))
+                        if frames:
+                            respond_frames(fromservers, traced_frames(
+                                job['version'], frames))
+                        if contflag and source in waiting:
+                            contflag = start(*waiting.pop(source))
+                        if not (contflag):
+                            fromservers.flush()
+                            return
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        os.close(finished_in)
+        os.close(finished_out)
 
+# A VersionReader subscribes a server's socket to the versions that it
+# wants and turns the messages that arrive on it into versions. If member
+# is set, it subscribes to the versions that the broker sends to that
+# member of a server group instead (see GroupMember).
 
-def server(func, filter=None):
-    context = zmq.Context()
+
+class VersionReader:
+    def __init__(self, socket, filter, deltas, conflate=True, data=False,
+                 member=None):
+        self.socket = socket
+        self.filter = filter
+        self.deltas = deltas
+        self.conflate = conflate
+        self.data = data
+        self.member = member
+        self.replica = member.topic if member else b''
+        self.documents = {}
+        self.waiting = {}
+        self.skipped = 0
+        subscribe(socket, delta_topic if deltas else version_topic, filter,
+                  self.replica)
+        if member is not None:
+            member.subscribe(socket)
+
+    # Given a message that has been received, also receive the messages
+    # that are waiting after it (at most limit of them) if conflating.
+    # Return a list of pairs of the newest version of each source and the
+    # number of older versions of that source that were skipped, in order
+    # of priority (see Version scheduling). Full versions are grouped by
+    # topic so that skipped versions are never decoded. Deltas have to be
+    # read since their edits are needed.
+
+    def read_latest(self, message, limit=1000):
+        messages = [message]
+        while self.conflate and len(messages) < limit:
+            try:
+                messages.append(recv_routed_noblock(self.socket))
+            except zmq.Again:
+                break
+        latest = {}
+        for message in messages:
+            message = self.route(*message)
+            if message is None:
+                continue
+            (topic, frames) = message
+            if topic and not self.deltas:
+                (key, item) = (topic, (topic, frames))
+            else:
+                item = self.read(topic, frames)
+                if item is None:
+                    continue
+                key = item['source']
+            if key in latest:
+                (older, skipped) = latest.pop(key)
+                if isinstance(item, dict):
+                    item = supersede_version(older, item)
+                latest[key] = (item, skipped + 1)
+                self.skipped += 1
+            else:
+                latest[key] = (item, 0)
+        versions = []
+        for (item, skipped) in latest.values():
+            version = item if isinstance(item, dict) else self.read(*item)
+            if version is not None:
+                versions.append((version, skipped))
+        versions.sort(key=lambda pair: priority_rank(pair[0].get('priority')))
+        return versions
+
+    # Return the version for a message that has been received, or None if
+    # the server should not process it. read does the same for a message
+    # that has been routed.
+
+    def read_message(self, topic, frames):
+        message = self.route(topic, frames)
+        return self.read(*message) if message is not None else None
+
+    # Remove the member's topic from a message, or return None if the
+    # message isn't a version.
+
+    def route(self, topic, frames):
+        if self.member is None:
+            return (topic, frames)
+        return self.member.route(topic, frames)
+
+    def read(self, topic, frames):
+        if self.deltas:
+            version = receive_delta(self.socket, self.documents, self.waiting,
+                                    topic, frames, self.data, self.replica)
+            if version is None:
+                return None
+        else:
+            version = decode_version(frames, self.data)
+        if topic or matches(self.filter, version['language']):
+            return version
+        else:
+            return None
+
+# Return the version that a server should process when a newer version of
+# the same source arrives before it has processed an older one. For
+# deltas, the edits of both versions are combined.
+
+
+def supersede_version(older, newer):
+    if newer.get('edits') is not None:
+        newer = dict(newer)
+        if older.get('edits') is None:
+            newer['edits'] = None
+        else:
+            newer['edits'] = older['edits'] + newer['edits']
+            newer['base'] = older['base']
+    return newer
+
+# A GroupMember makes a server a member of a server group (see Server
+# groups). A thread sends its heartbeats to the groups socket of each
+# shard, every HEARTBEAT milliseconds once every shard has welcomed it and
+# more often before then. done records that the server has finished a
+# version, and is reported straight away. reporter returns a report
+# function for server that calls done and then report. close tells the
+# broker that the member is leaving.
+
+WELCOME_INTERVAL = 0.1
+
+
+class GroupMember:
+    def __init__(self, group, filter, deltas):
+        self.id = os.urandom(8).hex()
+        self.topic = replica_topic(self.id)
+        self.header = {
+            'group': group,
+            'replica': self.id,
+            'languages': filter,
+            'deltas': deltas
+        }
+        self.welcomed = set()
+        self.finished = []
+        self.changed = False
+        self.closing = False
+        self.lock = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def subscribe(self, socket):
+        socket.setsockopt(zmq.SUBSCRIBE, self.topic + WELCOME_TOPIC)
+
+    def route(self, topic, frames):
+        if topic == self.topic + WELCOME_TOPIC:
+            with self.lock:
+                self.welcomed.add(decode_header(frames).get('shard'))
+                self.changed = True
+                self.lock.notify_all()
+            return None
+        return (topic[len(self.topic):], frames)
+
+    def done(self, source, revision):
+        with self.lock:
+            self.finished.append([source, revision])
+            self.changed = True
+            self.lock.notify_all()
+
+    def reporter(self, report):
+        def done(job):
+            self.done(job['source'], job['revision'])
+            if report:
+                report(job)
+        return done
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+            self.lock.notify_all()
+        self.thread.join(HEARTBEAT / 1000)
+
+    def _run(self):
+        context = zmq.Context()
+        sockets = []
+        for shard in SHARDS:
+            socket = context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.LINGER, HEARTBEAT)
+            connect(socket, shard['groups'])
+            sockets.append(socket)
+        closing = False
+        while not closing:
+            with self.lock:
+                if len(self.welcomed) < len(sockets):
+                    interval = WELCOME_INTERVAL
+                else:
+                    interval = HEARTBEAT / 1000
+                self.lock.wait_for(lambda: self.changed or self.closing,
+                                   interval)
+                (finished, self.finished) = (self.finished, [])
+                self.changed = False
+                closing = self.closing
+                welcomed = set(self.welcomed)
+            for (shard, socket) in enumerate(sockets):
+                header = dict(self.header, shard=shard,
+                              ready=shard in welcomed, done=finished)
+                if closing:
+                    header['leaving'] = True
+                try:
+                    socket.send_multipart([b'', encode_header(header)],
+                                          zmq.NOBLOCK)
+                except zmq.Again:
+                    pass
+        for socket in sockets:
+            socket.close()
+        context.term()
+
+# async_server
+
+# An asyncio version of server. func is a coroutine function with the same
+# arguments and results as the func of server. Versions of different
+# sources are processed concurrently, but only one version of each source
+# is processed at a time. If a version arrives while an older version of
+# its source is being processed, it waits until that is finished. Only the
+# newest waiting version of each source is processed. async_server returns
+# once func has returned a False continuation flag. cache, data and group
+# are as for server. An exception raised by func is reported, no products
+# are sent for that version, and later versions of its source are still
+# processed.
+
+# If cancel is True, a version that arrives while an older version of its
+# source is being processed cancels that processing instead of waiting for
+# it, so func has to clean up when it is cancelled (e.g., kill a process
+# that it started). No products are sent for the cancelled version. For
+# deltas, the new version gets the edits of both versions. For a pipeline
+# stage (see consumes in server), the processing is cancelled as soon as
+# the new version arrives, even if it then waits for products.
+
+
+async def async_server(func, filter=None, deltas=False, cache=None,
+                       cancel=False, data=False, group=None, consumes=None):
+    context = zmq_asyncio.Context.instance()
     toservers = context.socket(zmq.SUB)
-    toservers.connect(TOSERVERS)
-    toservers.setsockopt(zmq.SUBSCRIBE, b'')
-    fromservers = context.socket(zmq.REQ)
-    fromservers.connect(FROMSERVERS)
-    while True:
-        # print('server: waiting for version')
-        version_message = toservers.recv().decode()
-        version = json.loads(version_message)
-        # print('server: got version {0!s}'.format(version))
-        if not filter or filter == version['language']:
-            # print('server: func produced {0!s}'.format(func(version)))
-            (products, contflag) = func(version)
-            for product in products:
-                respond(fromservers, product)
-            if not (contflag):
-                return
+    connect_all(toservers, 'to_servers')
+    member = GroupMember(group, filter, deltas) if group else None
+    reader = VersionReader(toservers, filter, deltas, data=data,
+                           member=member)
+    fromservers = AsyncShards(context, from_servers())
+    inputs = ProductInputs(context, consumes) if consumes else None
+    running = {}
+    calls = {}
+    waiting = {}
+    finished = asyncio.Event()
+
+    # Handle the versions of a source one after another until none are
+    # waiting.
+
+    async def process(version):
+        source = version['source']
+        try:
+            while version is not None:
+                try:
+                    version = await process_version(version)
+                except Exception as err:
+                    error('server failed on {0} revision {1}: {2!r}'.format(
+                        source, version.get('revision'), err))
+                    if member is not None:
+                        member.done(source, version.get('revision'))
+                    version = waiting.pop(source, None)
+        finally:
+            calls.pop(source, None)
+            running.pop(source, None)
+
+    # Handle a version and return the next one of its source, if any.
+
+    async def process_version(version):
+        source = version['source']
+        result = stored_result(cache, inputs, version)
+        if result is None:
+            trace_hop(version, 'call')
+            call = asyncio.ensure_future(func(version))
+            calls[source] = call
+            await asyncio.wait([call])
+            del calls[source]
+            if call.cancelled():
+                if source in waiting:
+                    return supersede_version(version, waiting.pop(source))
+                if inputs is not None:
+                    inputs.restore(version)
+                return None
+            (products, contflag) = call.result()
+            trace_hop(version, 'return')
+            result = cache_result(cache, version, products, contflag)
+        else:
+            trace_hop(version, 'cached')
+        (frames, contflag) = result
+        if inputs is not None:
+            inputs.remember(version, frames)
+        if frames:
+            await fromservers.send(traced_frames(version, frames))
+        if member is not None:
+            member.done(source, version.get('revision'))
+        if not (contflag):
+            finished.set()
+        return waiting.pop(source, None)
+
+    def dispatch(version):
+        source = version['source']
+        if source in running:
+            if source in waiting:
+                version = supersede_version(waiting[source], version)
+            waiting[source] = version
+            if cancel and source in calls:
+                calls[source].cancel()
+        else:
+            running[source] = asyncio.ensure_future(process(version))
+
+    receive = None
+    consume = None
+    while not finished.is_set():
+        if receive is None:
+            receive = asyncio.ensure_future(
+                toservers.recv_multipart(copy=False))
+        if inputs is not None and consume is None:
+            consume = asyncio.ensure_future(
+                inputs.socket.recv_multipart(copy=False))
+        finish = asyncio.ensure_future(finished.wait())
+        await asyncio.wait([f for f in (receive, consume, finish) if f],
+                           return_when=asyncio.FIRST_COMPLETED)
+        finish.cancel()
+        if finished.is_set():
+            break
+        jobs = []
+        if receive.done():
+            version = reader.read_message(
+                *split_routed(frame_values(receive.result())))
+            receive = None
+            if version is not None:
+                trace_hop(version, 'server')
+                if inputs is None:
+                    jobs.append((version, 0))
+                else:
+                    if cancel and version['source'] in calls:
+                        calls[version['source']].cancel()
+                    jobs.extend(inputs.add_version(version, 0))
+        if consume is not None and consume.done():
+            jobs.extend(inputs.add_products(
+                *split_routed(frame_values(consume.result()))))
+            for message in await async_resync_tables(context, inputs.tables):
+                jobs.extend(inputs.add_products(*message))
+            consume = None
+        for (version, _) in jobs:
+            dispatch(version)
+    for future in (receive, consume):
+        if future is not None:
+            future.cancel()
+    await fromservers.flush()
+    fromservers.close()
+    toservers.close()
+    if member is not None:
+        member.close()
+    if inputs is not None:
+        inputs.close()
+
+# Update a server's documents from a delta message and return the version
+# that it produces, or None if there is nothing new to process. If the
+# server doesn't have the base revision for some edits, it subscribes to
+# the full versions of that source (as sent to replica, see
+# publish_replica) until it gets one. waiting maps such
+# sources to None, and then to the revision of the full version once it
+# has arrived, so that the delta for that revision can be skipped.
+
+
+def receive_delta(socket, documents, waiting, topic, frames, data=False,
+                  replica=b''):
+    version = decode_version(frames, data)
+    source = version['source']
+    revision = version.get('revision')
+    full = topic is not None and topic.startswith(version_topic())
+    if full:
+        if waiting.get(source, False) is not None:
+            return None
+    elif source in waiting:
+        if waiting[source] is not None:
+            if revision == waiting.pop(source):
+                return None
+        elif 'contents' not in version:
+            return None
+    document = documents.get(source)
+    if 'contents' in version:
+        documents[source] = new_document(revision, version['contents'])
+        if source in waiting:
+            socket.setsockopt(zmq.UNSUBSCRIBE, replica +
+                              version_topic(version['language'], source))
+            if full:
+                waiting[source] = revision
+            else:
+                del waiting[source]
+        version['edits'] = None
+    elif document and document.revision == version['base']:
+        if version['edits']:
+            document.apply(version['edits'], revision)
+        version['contents'] = document.data() if data else document.text()
+    else:
+        waiting[source] = None
+        socket.setsockopt(zmq.SUBSCRIBE, replica +
+                          version_topic(version['language'], source))
+        return None
+    return version
 
 # respond
 
-# Send a product from a server back to the broker as a JSON message.
+# Send a product from a server back to the broker as a header and contents.
+# socket can be a REQ socket or a Pipeline.
 
 
 def respond(socket, product):
-    # print('server: sent product {0!s}'.format(product))
-    product_message = json.dumps(product).encode()
-    socket.send(product_message)
-    # print('server: waiting for ack')
-    socket.recv()
-    # print('server: got ack')
+    respond_all(socket, [product])
+
+# Send a list of products in one message. Products that have a trace get
+# a 'respond' hop.
+
+
+def respond_all(socket, products):
+    # print('server: sent products {0!s}'.format(products))
+    for product in products:
+        trace_hop(product, 'respond')
+    respond_frames(socket, encode_products(products))
+
+# Send products that have already been encoded.
+
+
+def respond_frames(socket, frames):
+    if isinstance(socket, (Pipeline, Shards)):
+        socket.send(frames)
+    else:
+        socket.send_multipart(frames)
+        # print('server: waiting for ack')
+        socket.recv()
+        # print('server: got ack')
 
 # send_product
 
@@ -172,7 +3633,7 @@ def respond(socket, product):
 def send_product(product):
     context = zmq.Context()
     fromservers = context.socket(zmq.REQ)
-    fromservers.connect(FROMSERVERS)
+    connect(fromservers, shard_address(product['source'], 'from_servers'))
     respond(fromservers, product)
 
 # sink
@@ -181,60 +3642,781 @@ def send_product(product):
 # published to sinks by the broker. Each product is passed as JSON to
 # func. func should return a Boolean that indicates whether the sink
 # should continue or return. If raw=False (default), func will be passed
-# a dict, otherwise func will be passed a 'raw' JSON string.
+# a dict, otherwise func will be passed a 'raw' JSON string. If products is
+# set, only products with those names are received. Like the server filter,
+# it can be a single product name or a list of names.
+
+# If replay is True, the sink first asks the broker for the latest product
+# of each source that it has cached (see request_products) and passes them
+# to func before any new products.
 
+# If queue is set to a ProductQueue, the sink reads all of the products
+# that are waiting for it before each call of func and only keeps the
+# latest product for each source and product name, so a sink that is
+# slower than the servers handles the latest products instead of a backlog
+# of old ones. If batch is True, func is passed a list of all of the
+# products that are waiting instead of one product at a time (using a new
+# ProductQueue if queue isn't set). When func makes the sink return, it
+# returns the stats of its ProductQueue (see below), if it has one, so they
+# can be seen even if the sink made the queue itself.
 
-def sink(func, raw=False):
+# Splices of columnar products are applied as they arrive (see
+# ColumnTables), so func is always passed whole tables.
+
+
+def sink(func, raw=False, products=None, replay=False, queue=None,
+         batch=False):
     context = zmq.Context()
     tosinks = context.socket(zmq.SUB)
-    tosinks.connect(TOSINKS)
-    tosinks.setsockopt(zmq.SUBSCRIBE, b'')
+    connect_all(tosinks, 'to_sinks')
+    subscribe(tosinks, product_topic, products)
+    tables = ColumnTables()
+    if batch and queue is None:
+        queue = ProductQueue()
+    if replay:
+        replayed = applied_tables(tables, request_products(context, products))
+        if queue is not None:
+            for topic, frames in replayed:
+                queue.put(topic, frames)
+            replayed = []
+        for topic, frames in replayed:
+            product = read_product(topic, frames, raw, products)
+            if product is not None and not func(product):
+                return
+    if queue is not None:
+        sink_queued(func, context, tosinks, tables, raw, products, queue,
+                    batch)
+        return queue.stats
     while True:
         # print('sink: waiting for product')
-        product_message = tosinks.recv().decode()
-        product = product_message if raw else json.loads(product_message)
-        # print('sink: got product {0!s}'.format(product))
-        if not func(product):
-            break
+        for (topic, frames) in whole_products(context, tables,
+                                              recv_routed(tosinks)):
+            product = read_product(topic, frames, raw, products)
+            # print('sink: got product {0!s}'.format(product))
+            if product is not None and not func(product):
+                return
+
+
+def sink_queued(func, context, tosinks, tables, raw, products, queue, batch):
+    while True:
+        if not queue:
+            for message in whole_products(context, tables,
+                                          recv_routed(tosinks)):
+                queue.put(*message)
+        while True:
+            try:
+                message = recv_routed_noblock(tosinks)
+            except zmq.Again:
+                break
+            for message in whole_products(context, tables, message):
+                queue.put(*message)
+        if batch:
+            handled = read_products(queue.take_all(), raw, products)
+            if handled and not func(handled):
+                break
+        else:
+            product = read_product(*queue.take(), raw, products)
+            if product is not None and not func(product):
+                break
+
+# Product queues
+
+# A ProductQueue holds the products that a sink has received but not yet
+# handled. A product replaces any waiting product with the same topic, i.e.,
+# with the same source and product name, but keeps its place in the queue.
+# If limit is set and that many products are waiting, the oldest one is
+# dropped to make room for a product with a new topic. stats counts the
+# products that were received, delivered, conflated (replaced by a newer
+# one) and dropped.
+
+
+class ProductQueue:
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.waiting = collections.OrderedDict()
+        self.stats = {'received': 0, 'delivered': 0, 'conflated': 0,
+                      'dropped': 0}
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def put(self, topic, frames):
+        self.stats['received'] += 1
+        key = topic or product_key(frames)
+        if key in self.waiting:
+            self.stats['conflated'] += 1
+        elif self.limit is not None and len(self.waiting) >= self.limit:
+            self.waiting.popitem(last=False)
+            self.stats['dropped'] += 1
+        self.waiting[key] = (topic, frames)
+
+    # Return the topic and frames of the oldest waiting product.
+
+    def take(self):
+        (_, message) = self.waiting.popitem(last=False)
+        self.stats['delivered'] += 1
+        return message
+
+    def take_all(self):
+        messages = list(self.waiting.values())
+        self.waiting.clear()
+        self.stats['delivered'] += len(messages)
+        return messages
+
+# Return the messages of whole products for a message that a receiver
+# got, applying it if it is a splice (see ColumnTables). applied_tables
+# does the same for a list of messages of whole products, such as replayed
+# ones, which the receiver needs as the base of later splices.
+
+
+def whole_products(context, tables, message):
+    message = tables.apply(*message)
+    if message is not None:
+        return [message]
+    return resync_tables(context, tables)
+
+
+async def async_whole_products(context, tables, message):
+    message = tables.apply(*message)
+    if message is not None:
+        return [message]
+    return await async_resync_tables(context, tables)
+
+
+def applied_tables(tables, messages):
+    applied = (tables.apply(*message) for message in messages)
+    return [message for message in applied if message is not None]
+
+# Messages from brokers that don't send topics are keyed by the source and
+# product name from their header.
+
+
+def product_key(frames):
+    header = decode_header(frames)
+    return (header['source'], header['product'])
+
+# Ask the broker for its cached products that pass the products filter
+# (and the sources filter, if it is given) and return them as a list of
+# pairs of topic and frames. The request is sent after the sink has
+# subscribed, so no products are missed in between, but a product may be
+# received both ways. Returns an empty list if the broker doesn't reply
+# within timeout milliseconds (e.g., because it doesn't cache products).
+# With several shards, each of them is asked at once and those that reply
+# within timeout contribute their products.
+
+
+def request_products(context, products=None, timeout=1000, sources=None):
+    deadline = time.monotonic() + timeout / 1000
+    requests = send_product_requests(context, products, sources)
+    replayed = []
+    for fromsinks in requests:
+        if fromsinks.poll(remaining(deadline)):
+            replayed.extend(split_replay(fromsinks.recv_multipart()))
+        fromsinks.close()
+    return replayed
+
+
+def send_product_requests(context, products, sources=None):
+    requests = []
+    for shard in SHARDS:
+        fromsinks = context.socket(zmq.REQ)
+        fromsinks.setsockopt(zmq.LINGER, 0)
+        connect(fromsinks, shard['from_sinks'])
+        fromsinks.send(product_request(products, sources))
+        requests.append(fromsinks)
+    return requests
+
+
+def product_request(products, sources):
+    request = {'products': products}
+    if sources is not None:
+        request['sources'] = sources
+    return encode_header(request)
+
+
+def remaining(deadline):
+    return max(0, deadline - time.monotonic()) * 1000
+
+
+def split_replay(frames):
+    replayed = []
+    i = 0
+    while i < len(frames) and frames[i]:
+        count = int(frames[i])
+        replayed.append(split_routed(frames[i + 1:i + 1 + count]))
+        i += 1 + count
+    return replayed
+
+# Return the product for a message, or None if a sink should ignore it.
+# read_products does the same for a list of pairs of topic and frames and
+# returns the products that the sink shouldn't ignore.
+
+
+def read_product(topic, frames, raw, products):
+    product = decode_product(frames)
+    trace_hop(product, 'sink')
+    if topic or matches(products, product['product']):
+        if not raw:
+            return product
+        if isinstance(product['contents'], Columns):
+            product['contents'] = product['contents'].to_json()
+        return json.dumps(product)
+    else:
+        return None
+
+
+def read_products(messages, raw, products):
+    handled = []
+    for topic, frames in messages:
+        product = read_product(topic, frames, raw, products)
+        if product is not None:
+            handled.append(product)
+    return handled
+
+# async_sink
+
+# An asyncio version of sink. func is a coroutine function with the same
+# argument and result as the func of sink. Products are passed to func one
+# at a time in the order in which they arrive. replay, queue, batch and the
+# result are as for sink.
+
+
+async def async_sink(func, raw=False, products=None, replay=False,
+                     queue=None, batch=False):
+    context = zmq_asyncio.Context.instance()
+    tosinks = context.socket(zmq.SUB)
+    connect_all(tosinks, 'to_sinks')
+    subscribe(tosinks, product_topic, products)
+    tables = ColumnTables()
+    if batch and queue is None:
+        queue = ProductQueue()
+    if replay:
+        replayed = applied_tables(
+            tables, await async_request_products(context, products))
+        if queue is not None:
+            for topic, frames in replayed:
+                queue.put(topic, frames)
+            replayed = []
+        for topic, frames in replayed:
+            product = read_product(topic, frames, raw, products)
+            if product is not None and not await func(product):
+                tosinks.close()
+                return
+    if queue is not None:
+        await async_sink_queued(func, context, tosinks, tables, raw,
+                                products, queue, batch)
+        tosinks.close()
+        return queue.stats
+    while True:
+        frames = frame_values(await tosinks.recv_multipart(copy=False))
+        for (topic, frames) in await async_whole_products(
+                context, tables, split_routed(frames)):
+            product = read_product(topic, frames, raw, products)
+            if product is not None and not await func(product):
+                tosinks.close()
+                return
+
+
+async def async_sink_queued(func, context, tosinks, tables, raw, products,
+                            queue, batch):
+    while True:
+        while not queue or await tosinks.poll(0):
+            frames = await tosinks.recv_multipart(copy=False)
+            for message in await async_whole_products(
+                    context, tables, split_routed(frame_values(frames))):
+                queue.put(*message)
+        if batch:
+            handled = read_products(queue.take_all(), raw, products)
+            if handled and not await func(handled):
+                break
+        else:
+            product = read_product(*queue.take(), raw, products)
+            if product is not None and not await func(product):
+                break
+
+
+async def async_request_products(context, products=None, timeout=1000,
+                                 sources=None):
+    deadline = time.monotonic() + timeout / 1000
+    requests = []
+    for shard in SHARDS:
+        fromsinks = context.socket(zmq.REQ)
+        fromsinks.setsockopt(zmq.LINGER, 0)
+        connect(fromsinks, shard['from_sinks'])
+        await fromsinks.send(product_request(products, sources))
+        requests.append(fromsinks)
+    replayed = []
+    for fromsinks in requests:
+        if await fromsinks.poll(remaining(deadline)):
+            replayed.extend(split_replay(await fromsinks.recv_multipart()))
+        fromsinks.close()
+    return replayed
 
 # source
 
 # General functionality of Monto sources. Packaged as a class so that
 # the source can be used to publish versions from other code.
 
+# Versions are sent through a Pipeline, so publishing returns without
+# waiting for the broker to acknowledge the version unless window versions
+# are already waiting for acknowledgement. Call flush to wait until all
+# versions have been acknowledged and close when the source is finished.
+
+# If background is True, publishing never waits for the broker. Versions
+# are put in a slot for their source and a background thread sends them.
+# A version that is published while the previous one for the same source
+# is still waiting to be sent replaces it (edits are combined). At most
+# limit sources can have versions waiting. When a version is published for
+# another source, drop says what happens: 'oldest' drops the oldest waiting
+# version, 'newest' drops the new version and 'block' waits for a free
+# slot. Dropped edits are recovered from by sending full contents when the
+# broker asks for them. stats counts the versions that were published,
+# sent, coalesced and dropped. If the background thread fails, it stops and
+# its exception is raised by flush, close and any later publishing.
+
+# trace is the fraction of published versions that are traced (see
+# Tracing).
+
+# priority is the priority of the versions of the source (see Version
+# scheduling), e.g., 'background' for a source that indexes a project.
+# The publishing methods can override it for a version, e.g., with
+# 'interactive' for the buffer that has the focus in an editor.
+
+# If retain is False, the source only keeps the revision of each document
+# and not its contents, so it can only publish full versions. This is for
+# sources such as send.py that never send edits and would otherwise keep a
+# copy of every file that they have sent. forget drops everything that the
+# source keeps for a source that has gone away, e.g., a deleted file.
+
 
 class MontoSource:
-    def __init__(self):
+    def __init__(self, window=WINDOW, background=False, limit=1000,
+                 drop='oldest', trace=TRACE, priority=None, retain=True):
+        if drop not in ('oldest', 'newest', 'block'):
+            raise ValueError('unknown drop policy {0}'.format(drop))
         self.fromsources = None
+        self.window = window
+        self.documents = {}
+        self.selections = {}
+        self.resynced = {}
+        self.lock = threading.Condition()
+        self.stats = {'published': 0, 'sent': 0, 'coalesced': 0, 'dropped': 0}
+        self.trace = trace
+        self.priority = priority
+        self.retain = retain
+        self.background = background
+        if background:
+            self.limit = limit
+            self.drop = drop
+            self.pending = {}
+            self.flushing = False
+            self.closing = False
+            self.failure = None
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
 
     def _init_zmq_socket(self):
         self.context = zmq.Context()
-        self.fromsources = self.context.socket(zmq.REQ)
-        self.fromsources.connect(FROMSOURCES)
+        self.fromsources = Shards(self.context, from_sources(), self.window)
+
+    def _close_zmq_socket(self):
+        self.fromsources.close()
+        self.context.term()
+        self.fromsources = None
 
     # Send a version message to the Monto broker. The message will be sent as
-    # JSON with 'source', 'language', 'contents' and 'selections' fields
-    # specified by the arguments. source should be a unique name but doesn't
-    # have to reference anything in particular; often it is the name of the
-    # file from which the contents came. language should be the name of the
-    # language of the contents. The selection is a list of selection objects
-    # that contain 'begin' and 'end' fields and defaults to the empty list.
-
-    def publish_version(self, source, language, contents, selections=[]):
-        if self.fromsources is None:
-            self._init_zmq_socket()
-        version = {
+    # a JSON header with 'source', 'language' and 'selections' fields followed
+    # by the contents (see encode_version), specified by the arguments.
+    # source should be a unique name but doesn't have to reference anything
+    # in particular; often it is the name of the file from which the contents
+    # came. language should be the name of the language of the contents. The
+    # selection is a list of selection objects that contain 'begin' and 'end'
+    # fields and defaults to the empty list.
+
+    # contents can also be a bytes-like object that holds UTF-8 text, such
+    # as an mmap of a file. It is then sent without being decoded or copied,
+    # and must not change until the source is closed, since the source may
+    # have to send it again. If hash is given, it is used as the contents
+    # hash instead of computing it again.
+
+    def publish_version(self, source, language, contents, selections=[],
+                        hash=None, priority=None):
+        self._submit(self._prioritize(
+            self._new_version(source, language, contents, selections, hash),
+            priority))
+
+    def _new_version(self, source, language, contents, selections,
+                     hash=None):
+        with self.lock:
+            document = self.documents.get(source)
+            revision = document.revision + 1 if document else 1
+            self.documents[source] = new_document(revision, contents)
+            self.selections[source] = selections
+            version = self._full_version(source, language)
+            if hash is not None:
+                version['hash'] = hash
+            if not self.retain:
+                self.documents[source] = Document(revision)
+            return version
+
+    def _full_version(self, source, language):
+        document = self.documents[source]
+        return {
             'source': source,
             'language': language.lower(),
-            'contents': contents,
-            'selections': selections
+            'contents': document.contents(),
+            'selections': self.selections[source],
+            'revision': document.revision
         }
+
+    # Send the edits that have been made to a source since its last version
+    # (see Documents above). A version of the source must have been published
+    # by this MontoSource before. Only the edits are sent, unless the broker
+    # asks for the full contents.
+
+    def publish_edits(self, source, language, edits, selections=[],
+                      priority=None):
+        self._submit(self._prioritize(
+            self._new_edits(source, language, edits, selections), priority))
+
+    def _new_edits(self, source, language, edits, selections):
+        with self.lock:
+            document = self._document(source)
+            base = document.revision
+            document.apply(edits, base + 1)
+            self.selections[source] = selections
+            version = {
+                'source': source,
+                'language': language.lower(),
+                'selections': selections,
+                'revision': document.revision,
+                'base': base,
+                'edits': edits
+            }
+        return version
+
+    # Send a change of selections without any change to the contents.
+
+    def publish_selections(self, source, language, selections,
+                           priority=None):
+        self._submit(self._prioritize(
+            self._new_selections(source, language, selections), priority))
+
+    def _new_selections(self, source, language, selections):
+        with self.lock:
+            document = self._document(source)
+            self.selections[source] = selections
+            return {
+                'source': source,
+                'language': language.lower(),
+                'selections': selections,
+                'revision': document.revision
+            }
+
+    def _prioritize(self, version, priority):
+        priority = priority or self.priority
+        if priority is not None:
+            version['priority'] = priority
+        return version
+
+    def _document(self, source):
+        if not self.retain:
+            raise ValueError('a source that doesn\'t retain documents can '
+                             'only publish full versions')
+        if source not in self.documents:
+            raise ValueError('no version of {0} has been published'.format(
+                source))
+        return self.documents[source]
+
+    def forget(self, source):
+        with self.lock:
+            self.documents.pop(source, None)
+            self.selections.pop(source, None)
+            self.resynced.pop(source, None)
+
+    # Send a version, or put it in its slot if sending in the background.
+
+    def _submit(self, version):
+        self._start_trace(version)
+        if not self.background:
+            self.stats['published'] += 1
+            self._send(version)
+            return
+        source = version['source']
+        with self.lock:
+            self._check_failure()
+            self.stats['published'] += 1
+            if source in self.pending:
+                self.pending[source] = coalesce_versions(self.pending[source],
+                                                         version)
+                self.stats['coalesced'] += 1
+                return
+            if len(self.pending) >= self.limit:
+                if self.drop == 'newest':
+                    self.stats['dropped'] += 1
+                    return
+                elif self.drop == 'oldest':
+                    del self.pending[next(iter(self.pending))]
+                    self.stats['dropped'] += 1
+                else:
+                    self.lock.wait_for(
+                        lambda: self.failure or len(self.pending) < self.limit)
+                    self._check_failure()
+            self.pending[source] = version
+            self.lock.notify_all()
+
+    def _start_trace(self, version):
+        if self.trace and random.random() < self.trace:
+            version['trace'] = new_trace()
+
+    # Send a version to the broker, then deal with any requests from the
+    # broker to send full contents. Requests that refer to edits sent before
+    # the latest full contents of their source are ignored.
+
+    def _send(self, version):
         # print('source: sent version {0!s}'.format(version))
-        version_message = json.dumps(version).encode()
-        self.fromsources.send(version_message)
-        # print('source: waiting for ack')
-        self.fromsources.recv()
-        # print('source: got ack')
+        trace_hop(version, 'send')
+        if self.fromsources is None:
+            self._init_zmq_socket()
+        version = self._complete(version)
+        self.fromsources.pipeline(version['source']).send(
+            encode_source_version(version),
+            (version['source'], version['language']))
+        self._sent(version)
+        self._resync()
+
+    # Brokers that don't pipeline (see Pipelining) don't keep documents, so
+    # edits and changes of selections are sent to them as full versions.
+
+    def _complete(self, version):
+        if PIPELINE or 'contents' in version:
+            return version
+        with self.lock:
+            full = self._full_version(version['source'], version['language'])
+        for name in ('trace', 'priority'):
+            if name in version:
+                full[name] = version[name]
+        return full
+
+    def _sent(self, version):
+        self.stats['sent'] += 1
+        if 'contents' in version:
+            source = version['source']
+            self.resynced[source] = self.fromsources.pipeline(source).sequence
+
+    def _resync(self):
+        for version in self._resync_versions():
+            self._send(version)
+
+    def _resync_versions(self):
+        versions = []
+        for reply, sequence, tag in self.fromsources.take_replies():
+            (source, language) = tag
+            if reply == RESYNC and sequence > self.resynced.get(source, 0):
+                # print('source: resync {0}'.format(source))
+                with self.lock:
+                    versions.append(self._prioritize(
+                        self._full_version(source, language), None))
+                self.resynced[source] = \
+                    self.fromsources.pipeline(source).sequence
+        return versions
+
+    # The background thread sends waiting versions and receives replies
+    # from the broker until the source is closed or an exception is raised,
+    # which is kept as failure for the threads waiting for it.
+
+    def _run(self):
+        failure = None
+        try:
+            self._init_zmq_socket()
+            self._run_loop()
+        except Exception as err:
+            failure = err
+        finally:
+            if self.fromsources is not None:
+                self._close_zmq_socket()
+            with self.lock:
+                self.failure = failure
+                self.flushing = False
+                self.lock.notify_all()
+
+    def _run_loop(self):
+        while True:
+            with self.lock:
+                if not (self.pending or self.flushing or self.closing):
+                    self.lock.wait(0.1)
+                versions = list(self.pending.values())
+                self.pending.clear()
+                flushing = self.flushing or self.closing
+                self.lock.notify_all()
+            for version in versions:
+                self._send(version)
+            if flushing:
+                self._flush_pipeline()
+            else:
+                self.fromsources.poll()
+                self._resync()
+            with self.lock:
+                if flushing and not self.pending:
+                    self.flushing = False
+                    if self.closing:
+                        return
+                    self.lock.notify_all()
+
+    def _check_failure(self):
+        if self.failure is not None:
+            raise self.failure
+
+    def _flush_pipeline(self):
+        while True:
+            self.fromsources.flush()
+            self._resync()
+            if self.fromsources.flushed():
+                break
+
+    # Wait until the broker has acknowledged all versions. When sending in
+    # the background, wait for at most timeout seconds (forever if None)
+    # and return whether everything was acknowledged in time.
+
+    def flush(self, timeout=None):
+        if not self.background:
+            if self.fromsources is not None:
+                self._flush_pipeline()
+            return True
+        with self.lock:
+            self._check_failure()
+            self.flushing = True
+            self.lock.notify_all()
+            flushed = self.lock.wait_for(
+                lambda: self.failure or not (self.flushing or self.pending),
+                timeout)
+            self._check_failure()
+            return flushed
+
+    def close(self, timeout=None):
+        if not self.background:
+            if self.fromsources is not None:
+                self.flush()
+                self._close_zmq_socket()
+            return True
+        with self.lock:
+            self.closing = True
+            self.lock.notify_all()
+        self.thread.join(timeout)
+        with self.lock:
+            self._check_failure()
+        return not self.thread.is_alive()
+
+# Encode a version as sent by a source, with or without contents.
+
+
+def encode_source_version(version):
+    if 'contents' in version:
+        return encode_version(version)
+    else:
+        return [encode_header(version)]
+
+# AsyncMontoSource
+
+# An asyncio version of MontoSource. The publishing methods, flush and
+# close are coroutines. It doesn't support sending in the background since
+# publishing only waits for the broker if window versions are already
+# waiting for acknowledgement.
+
+
+class AsyncMontoSource(MontoSource):
+    def __init__(self, window=WINDOW, trace=TRACE, priority=None,
+                 retain=True):
+        MontoSource.__init__(self, window, trace=trace, priority=priority,
+                             retain=retain)
+
+    def _init_zmq_socket(self):
+        self.context = zmq_asyncio.Context()
+        self.fromsources = AsyncShards(self.context, from_sources(),
+                                       self.window)
+
+    async def publish_version(self, source, language, contents,
+                              selections=[], hash=None, priority=None):
+        await self._submit(self._prioritize(
+            self._new_version(source, language, contents, selections, hash),
+            priority))
+
+    async def publish_edits(self, source, language, edits, selections=[],
+                            priority=None):
+        await self._submit(self._prioritize(
+            self._new_edits(source, language, edits, selections), priority))
+
+    async def publish_selections(self, source, language, selections,
+                                 priority=None):
+        await self._submit(self._prioritize(
+            self._new_selections(source, language, selections), priority))
+
+    async def _submit(self, version):
+        self._start_trace(version)
+        self.stats['published'] += 1
+        await self._send(version)
+
+    async def _send(self, version):
+        trace_hop(version, 'send')
+        if self.fromsources is None:
+            self._init_zmq_socket()
+        version = self._complete(version)
+        await self.fromsources.pipeline(version['source']).send(
+            encode_source_version(version),
+            (version['source'], version['language']))
+        self._sent(version)
+        await self._resync()
+
+    async def _resync(self):
+        for version in self._resync_versions():
+            await self._send(version)
+
+    async def flush(self):
+        if self.fromsources is not None:
+            while True:
+                await self.fromsources.flush()
+                await self._resync()
+                if self.fromsources.flushed():
+                    break
+
+    async def close(self):
+        if self.fromsources is not None:
+            await self.flush()
+            self._close_zmq_socket()
+
+# Combine a version that is waiting to be sent with a later version of the
+# same source. The result has the higher priority of the two.
+
+
+def coalesce_versions(older, newer):
+    priority = min(older.get('priority'), newer.get('priority'),
+                   key=priority_rank)
+    version = dict(combine_versions(older, newer))
+    version.pop('priority', None)
+    if priority is not None:
+        version['priority'] = priority
+    return version
+
+
+def combine_versions(older, newer):
+    if 'contents' in newer:
+        return newer
+    version = dict(older)
+    version.pop('trace', None)
+    if 'trace' in newer:
+        version['trace'] = newer['trace']
+    version['selections'] = newer['selections']
+    if 'edits' in newer:
+        if 'contents' in older:
+            version.pop('hash', None)
+            version['contents'] = apply_edits(
+                contents_text(older['contents']), newer['edits'])
+        elif 'edits' in older:
+            version['edits'] = older['edits'] + newer['edits']
+        else:
+            return newer
+        version['revision'] = newer['revision']
+    return version
 
 # Selections
 
@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+# record
+# Record the traffic that passes through a Monto broker in a log file.
+
+import getopt
+import sys
+import time
+
+import montolib
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:h',
+                                   ['duration=', 'help'])
+    except getopt.GetoptError as err:
+        error(err)
+        sys.exit(1)
+    duration = None
+    for o, a in opts:
+        if o in ('-d', '--duration'):
+            try:
+                duration = float(a)
+            except ValueError:
+                error('duration \'{0}\' is not a number'.format(a))
+                sys.exit(2)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+    if len(args) != 1:
+        error('expected one log file name')
+        sys.exit(2)
+    record(args[0], duration)
+
+
+def error(msg):
+    print('record: {0!s}'.format(msg))
+    usage()
+
+
+def usage():
+    print('usage: record [-d duration] logfile')
+
+# Record
+
+# Record what sources send to the broker (from its tap socket), the full
+# versions that the broker publishes to servers and the products that it
+# publishes to sinks, until interrupted or for duration seconds.
+
+
+def record(filename, duration):
+    context = montolib.zmq.Context()
+    tap = context.socket(montolib.zmq.SUB)
+    montolib.connect_all(tap, 'tap')
+    tap.setsockopt(montolib.zmq.SUBSCRIBE, montolib.source_topic())
+    toservers = context.socket(montolib.zmq.SUB)
+    montolib.connect_all(toservers, 'to_servers')
+    montolib.subscribe(toservers, montolib.version_topic)
+    tosinks = context.socket(montolib.zmq.SUB)
+    montolib.connect_all(tosinks, 'to_sinks')
+    montolib.subscribe(tosinks, montolib.product_topic)
+    streams = {tap: 'source', toservers: 'version', tosinks: 'product'}
+
+    poller = montolib.zmq.Poller()
+    for socket in streams:
+        poller.register(socket, montolib.zmq.POLLIN)
+
+    start = time.monotonic()
+    counts = {stream: 0 for stream in streams.values()}
+    with montolib.open_log(filename, 'w') as file:
+        try:
+            while duration is None or time.monotonic() - start < duration:
+                for socket, _ in poller.poll(1000):
+                    (_, frames) = montolib.recv_routed(socket)
+                    stream = streams[socket]
+                    montolib.write_record(file, time.monotonic() - start,
+                                          stream, frames)
+                    counts[stream] += 1
+        except KeyboardInterrupt:
+            pass
+    print('record: {0} source messages, {1} versions, {2} products'.format(
+        counts['source'], counts['version'], counts['product']))
+
+# Startup
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#! /usr/bin/env python3
+# replay
+# Replay the versions in a log file that was made by record.py and check
+# that the products are the same as the ones that were recorded.
+
+import getopt
+import sys
+import time
+
+import montolib
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hms:vw:',
+                                   ['help', 'maximum', 'speed=', 'verbose',
+                                    'wait='])
+    except getopt.GetoptError as err:
+        error(err)
+        sys.exit(1)
+    speed = 1.0
+    verbose = False
+    wait = 5.0
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-m', '--maximum'):
+            speed = None
+        elif o in ('-s', '--speed'):
+            speed = numarg(a, 'speed')
+        elif o in ('-v', '--verbose'):
+            verbose = True
+        elif o in ('-w', '--wait'):
+            wait = numarg(a, 'wait')
+        else:
+            assert False, 'unhandled option'
+    if len(args) != 1:
+        error('expected one log file name')
+        sys.exit(2)
+    if not replay(args[0], speed, wait, verbose):
+        sys.exit(1)
+
+
+def error(msg):
+    print('replay: {0!s}'.format(msg))
+    usage()
+
+
+def usage():
+    print('usage: replay [-m] [-s speed] [-v] [-w wait] logfile')
+
+
+def numarg(arg, what):
+    try:
+        return float(arg)
+    except ValueError:
+        error('{0} \'{1}\' is not a number'.format(what, arg))
+        sys.exit(2)
+
+# Replay
+
+# If the log has messages from sources, they are sent again as they were
+# recorded: as full versions, edits or selection changes, with their recorded
+# priorities. Recorded versions are then only used to start off sources whose
+# first recorded message is an edit, since the version that the broker
+# published last before an edit contains all of the changes that came before
+# it. If the log has no messages from sources (e.g., because it was recorded
+# from a broker without a tap socket) the recorded versions are sent instead.
+
+# Messages are sent at their recorded times, divided by speed, or as fast
+# as possible if speed is None. The products that arrive while replaying
+# and for up to wait seconds afterwards are compared with the last product
+# that was recorded for each source and product name. Returns True if they
+# are all the same.
+
+# Products are compared as decoded by comparable, since some fields of
+# their headers differ from run to run even if the products are the same.
+# Splices of columnar products are applied first (see ColumnTables in
+# montolib) so that whole tables are compared. Received splices whose base
+# table is missing are replaced by the whole table from the broker.
+
+STARTUP = 1.0
+
+
+def replay(filename, speed, wait, verbose):
+    with montolib.open_log(filename, 'r') as file:
+        records = list(montolib.read_records(file))
+    fromsources = any(stream == 'source' for (_, stream, _) in records)
+    expected = {}
+    tables = montolib.ColumnTables()
+    for (_, stream, frames) in records:
+        if stream == 'product':
+            for product in montolib.split_products(frames):
+                add_product(expected, tables, product)
+
+    context = montolib.zmq.Context()
+    tosinks = context.socket(montolib.zmq.SUB)
+    montolib.connect_all(tosinks, 'to_sinks')
+    montolib.subscribe(tosinks, montolib.product_topic)
+    received = {}
+    tables = montolib.ColumnTables()
+    receive_products(tosinks, received, tables, time.monotonic() + STARTUP)
+
+    source = montolib.MontoSource()
+    started = set()
+    start = time.monotonic()
+    sent = 0
+    for (when, stream, frames) in records:
+        if stream == 'product':
+            continue
+        if speed is None:
+            receive_products(tosinks, received, tables, time.monotonic())
+        else:
+            receive_products(tosinks, received, tables,
+                             start + when / speed)
+        version = montolib.decode_version(frames)
+        if stream == 'version':
+            if fromsources and version['source'] in started:
+                continue
+            publish = source.publish_version
+            args = (version['contents'],)
+        elif 'contents' in version:
+            publish = source.publish_version
+            args = (version['contents'],)
+        elif version['source'] not in started:
+            continue
+        elif 'edits' in version:
+            publish = source.publish_edits
+            args = (version['edits'],)
+        else:
+            publish = source.publish_selections
+            args = ()
+        publish(version['source'], version['language'], *args,
+                version.get('selections', []),
+                priority=version.get('priority'))
+        started.add(version['source'])
+        sent += 1
+    source.flush()
+    elapsed = time.monotonic() - start
+    compared = [key for key in expected if key[0] in started]
+    receive_products(tosinks, received, tables, time.monotonic() + wait,
+                     lambda: all(received.get(key) == expected[key]
+                                 for key in compared))
+    source.close()
+
+    same = [key for key in compared if received.get(key) == expected[key]]
+    missing = [key for key in compared if key not in received]
+    different = [key for key in compared
+                 if key in received and received[key] != expected[key]]
+    print('replay: sent {0} messages in {1:.3f}s'.format(sent, elapsed))
+    print('replay: {0} products the same, {1} different, {2} missing'.format(
+        len(same), len(different), len(missing)))
+    if verbose:
+        for (source, product) in different:
+            print('  different: {0} {1}'.format(product, source))
+        for (source, product) in missing:
+            print('  missing: {0} {1}'.format(product, source))
+    return not (different or missing)
+
+# Receive products until deadline or until done returns True, keeping the
+# last one for each source and product name.
+
+
+def receive_products(tosinks, received, tables, deadline,
+                     done=lambda: False):
+    while not done():
+        timeout = max(0, deadline - time.monotonic())
+        if not tosinks.poll(timeout * 1000):
+            return
+        (_, frames) = montolib.recv_routed(tosinks)
+        for product in montolib.split_products(frames):
+            add_product(received, tables, product)
+        for (_, frames) in montolib.resync_tables(tosinks.context, tables):
+            received[montolib.product_key(frames)] = comparable(frames)
+
+
+def add_product(products, tables, frames):
+    message = tables.apply(None, frames)
+    if message is not None:
+        products[montolib.product_key(frames)] = comparable(message[1])
+
+# Decode a product without the fields that can differ between runs that
+# produce the same product: the trace, the id of a table and the hash of
+# the version that it was made from, which products recorded from older
+# servers don't have. Tables are compared as JSON.
+
+VOLATILE = ('trace', 'table', 'version_hash')
+
+
+def comparable(frames):
+    product = montolib.decode_product(frames)
+    for name in VOLATILE:
+        product.pop(name, None)
+    if isinstance(product.get('contents'), montolib.Columns):
+        product['contents'] = product['contents'].to_json()
+    return product
+
+# Startup
+
+if __name__ == '__main__':
+    main()
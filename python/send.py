@@ -1,35 +1,61 @@
 #! /usr/bin/env python3
 # Send files to Monto.
 
+import codecs
+import concurrent.futures
 import getopt
+import glob
+import mmap
 import os
 import re
 import sys
+import time
 
-from montolib import MontoSource
+from montolib import MontoSource, PRIORITIES, content_hash
 
 
 def main():
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-                                   'c:hs:',
-                                   ['chnglang', 'help', 'selection'])
+                                   'c:hi:j:p:s:vw',
+                                   ['chnglang', 'help', 'interval=', 'jobs=',
+                                    'priority=', 'selection', 'verbose',
+                                    'watch'])
     except getopt.GetoptError as err:
         error(err)
         sys.exit(1)
     chnglang = None
+    interval = 1.0
+    jobs = 8
+    priority = None
     selections = []
+    verbose = False
+    watch = False
     for o, a in opts:
         if o in ('-c', '--chnglang'):
             chnglang = a
         elif o in ('-h', '--help'):
             usage()
             sys.exit(2)
+        elif o in ('-i', '--interval'):
+            interval = numarg(a, float, 'interval')
+        elif o in ('-j', '--jobs'):
+            jobs = numarg(a, int, 'number of jobs')
+        elif o in ('-p', '--priority'):
+            if a not in PRIORITIES:
+                error('unknown priority \'{0}\''.format(a))
+                sys.exit(4)
+            priority = a
         elif o in ('-s', '--selection'):
             selections.append(selargtoobj(a))
+        elif o in ('-v', '--verbose'):
+            verbose = True
+        elif o in ('-w', '--watch'):
+            watch = True
         else:
             assert False, 'unhandled option'
-    send(args, chnglang, selections)
+    send(args, chnglang, selections, watch, interval, jobs, verbose,
+         priority)
 
 
 def error(msg):
@@ -37,8 +63,21 @@ def error(msg):
     usage()
 
 
+def warning(msg):
+    print('send: {0!s}'.format(msg))
+
+
 def usage():
-    print('usage: send [-c chnglang] [-s begin:end] file...')
+    print('usage: send [-c chnglang] [-i interval] [-j jobs] [-p priority] '
+          '[-s begin:end] [-v] [-w] file|directory|pattern...')
+
+
+def numarg(arg, type, what):
+    try:
+        return type(arg)
+    except ValueError:
+        error('{0} \'{1}\' is not a number'.format(what, arg))
+        sys.exit(4)
 
 
 def selargtoobj(selarg):
@@ -57,27 +96,168 @@ def selargtoobj(selarg):
 
 # Send
 
+# Arguments can be files, directories, whose files are sent recursively
+# (skipping hidden files and directories), or glob patterns, where '**'
+# matches any number of directories. All versions are sent over one
+# connection. Files are read by a pool of jobs threads, BATCH files at a
+# time, while the versions of the previous ones are in flight.
 
-def send(filenames, chnglang, selections):
-    for filename in filenames:
-        _, language = os.path.splitext(filename)
-        if chnglang:
-            language = chnglang
-        elif language == '':
-            language = 'text'
-        else:
-            language = language[1:]
-        source = MontoSource()
+# An index records the modification time, size and contents hash of each
+# file that has been sent. If watch is True, the arguments are scanned again
+# every interval seconds and only files whose contents have changed are
+# sent again. Files whose modification time and size haven't changed
+# aren't even read. If verbose is True, the time that each scan took is
+# reported. Versions have the given priority (e.g., 'background' so that
+# indexing a project doesn't hold up the versions of an editor). Only full
+# versions are sent, so the source doesn't retain the contents of the
+# files, and it forgets files that are no longer found.
+
+# Unless watch is True, files of at least MMAP_SIZE bytes are mapped into
+# memory instead of being read, and their contents are sent straight from
+# the mapping without being decoded or copied (see
+# MontoSource.publish_version), so sending a large file needs little more
+# memory than the file itself. Each mapping holds a file descriptor until
+# it has been sent, so the versions of a batch with mapped files are
+# flushed before the next batch is read. Mapped files must not be truncated
+# while they are being sent. Files that are watched are expected to be
+# rewritten, so they are always read.
+
+BATCH = 256
+MMAP_SIZE = 1024 * 1024
+
+
+def send(args, chnglang, selections, watch=False, interval=1.0, jobs=8,
+         verbose=False, priority=None):
+    source = MontoSource(priority=priority, retain=False)
+    index = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            scan(source, pool, args, chnglang, selections, index, verbose,
+                 None if watch else MMAP_SIZE)
+            while watch:
+                time.sleep(interval)
+                scan(source, pool, args, chnglang, selections, index, verbose,
+                     None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.close()
+
+
+def scan(source, pool, args, chnglang, selections, index, verbose,
+         mmap_size):
+    start = time.monotonic()
+    seen = set()
+    changed = []
+    for filename in expand_args(args):
+        path = os.path.abspath(filename)
+        if path in seen:
+            continue
+        seen.add(path)
         try:
-            source.publish_version(
-                os.path.abspath(filename),
-                language,
-                open(filename).read(),
-                selections
-            )
+            stat = os.stat(path)
         except OSError as err:
-            error('error publishing version of {0}: {1}'.format(
+            warning('error publishing version of {0}: {1}'.format(
                 filename, err.strerror))
+            continue
+        entry = index.get(path)
+        if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+            changed.append((filename, path, stat))
+    for path in set(index) - seen:
+        del index[path]
+        source.forget(path)
+    published = 0
+    for i in range(0, len(changed), BATCH):
+        mapped = False
+        for (filename, path, stat, data) in pool.map(
+                lambda change: read_file(change, mmap_size),
+                changed[i:i + BATCH]):
+            if isinstance(data, OSError):
+                warning('error publishing version of {0}: {1}'.format(
+                    filename, data.strerror))
+                continue
+            hash = content_hash(data)
+            entry = index.get(path)
+            index[path] = (stat.st_mtime_ns, stat.st_size, hash)
+            if entry is not None and entry[2] == hash:
+                continue
+            if not is_utf8(data):
+                if verbose:
+                    warning('skipping {0}: not UTF-8 text'.format(filename))
+                continue
+            source.publish_version(path, file_language(filename, chnglang),
+                                   data, selections, hash)
+            published += 1
+            mapped = mapped or isinstance(data, mmap.mmap)
+        if mapped:
+            source.flush()
+    source.flush()
+    if verbose:
+        warning('scanned {0} files in {1:.3f}s: {2} read, {3} published'
+                .format(len(seen), time.monotonic() - start, len(changed),
+                        published))
+
+
+def read_file(change, mmap_size):
+    (filename, path, stat) = change
+    try:
+        with open(path, 'rb') as file:
+            if mmap_size is not None and stat.st_size >= mmap_size:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = file.read()
+            return (filename, path, stat, data)
+    except OSError as err:
+        return (filename, path, stat, err)
+
+# Check that data is UTF-8 a chunk at a time, so that the check doesn't
+# need a decoded copy of the whole file.
+
+CHUNK = 1024 * 1024
+
+
+def is_utf8(data):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    view = memoryview(data)
+    try:
+        for i in range(0, len(view), CHUNK):
+            decoder.decode(view[i:i + CHUNK])
+        decoder.decode(b'', True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def expand_args(args):
+    for arg in args:
+        if os.path.isdir(arg):
+            yield from walk_files(arg)
+        elif os.path.exists(arg) or not re.search(r'[*?[]', arg):
+            yield arg
+        else:
+            for match in sorted(glob.glob(arg, recursive=True)):
+                if os.path.isdir(match):
+                    yield from walk_files(match)
+                else:
+                    yield match
+
+
+def walk_files(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if not name.startswith('.'):
+                yield os.path.join(root, name)
+
+
+def file_language(filename, chnglang):
+    _, language = os.path.splitext(filename)
+    if chnglang:
+        return chnglang
+    elif language == '':
+        return 'text'
+    else:
+        return language[1:]
 
 
 # Startup
@@ -10,11 +10,15 @@ setup(name='Monto',
       author_email='inkytonik@gmail.com',
       url='https://bitbucket.org/inkytonik/monto/',
       install_requires=['psutil', 'pyzmq'],
-      scripts=['broker.py',
+      scripts=['bench.py',
+               'broker.py',
+               'latency.py',
                'length.py',
                'monto.py',
                'print.py',
+               'record.py',
                'reflect.py',
+               'replay.py',
                'reverse.py',
                'send.py',
                'wrap.py', ],
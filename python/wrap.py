@@ -1,10 +1,12 @@
 #! /usr/bin/env python3
 # Wrap a shell command as a Monto server
 
+import asyncio
 import getopt
+import json
 import os
-import pathlib
 import re
+import signal
 import subprocess
 import sys
 import tempfile
@@ -15,17 +17,54 @@ import montolib
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'mv:h', ['message', 'verslang', 'help'])
+        opts, args = getopt.getopt(sys.argv[1:], 'c:g:kmpt:u:v:w:h',
+                                   ['cache=', 'group=', 'kill', 'message',
+                                    'persistent',
+                                    'timeout=', 'uses=', 'verslang',
+                                    'workers=', 'help'])
     except getopt.GetoptError as err:
         error(err)
         sys.exit(2)
+    cache = None
+    group = None
+    kill = False
     message = False
+    persistent = False
+    timeout = None
+    uses = None
     verslang = None
+    workers = 1
     for o, a in opts:
-        if o in ('-m', '--message'):
+        if o in ('-c', '--cache'):
+            try:
+                cache = montolib.ResultCache(int(a))
+            except ValueError:
+                error('cache size \'{0}\' is not a number'.format(a))
+                sys.exit(2)
+        elif o in ('-g', '--group'):
+            group = a
+        elif o in ('-k', '--kill'):
+            kill = True
+        elif o in ('-m', '--message'):
             message = True
+        elif o in ('-p', '--persistent'):
+            persistent = True
+        elif o in ('-t', '--timeout'):
+            try:
+                timeout = float(a)
+            except ValueError:
+                error('timeout \'{0}\' is not a number'.format(a))
+                sys.exit(2)
+        elif o in ('-u', '--uses'):
+            uses = a.split(',')
         elif o in ('-v', '--verslang'):
             verslang = a
+        elif o in ('-w', '--workers'):
+            try:
+                workers = int(a)
+            except ValueError:
+                error('number of workers \'{0}\' is not a number'.format(a))
+                sys.exit(2)
         elif o in ('-h', '--help'):
             usage()
             sys.exit()
@@ -34,9 +73,12 @@ def main():
     if len(args) < 3:
         error('not enough arguments')
     else:
-        tmpfile = tempfile.mkstemp(suffix='.txt', text=True)
-        wrap(verslang, message, args[0], args[1], args[2:], pathlib.Path(tmpfile[1]))
-        os.unlink(tmpfile[1])
+        if persistent:
+            runner = WorkerPool(args[2:], workers, timeout)
+        else:
+            runner = CommandRunner(args[2:], workers, timeout)
+        wrap(verslang, message, args[0], args[1], runner, cache, kill, group,
+             uses)
 
 
 def error(msg):
@@ -45,28 +87,47 @@ def error(msg):
 
 
 def usage():
-    print('usage: wrap [-m] [-v verslang] product prodlang command args...')
+    print('usage: wrap [-c entries] [-g group] [-k] [-m] [-p] [-t timeout] '
+          '[-u products] [-v verslang] [-w workers] '
+          'product prodlang command args...')
 
 # Wrapping
 
+# Versions of different sources are run concurrently, at most as many at a
+# time as the runner has workers. If kill is True, a run is killed when a
+# newer version of its source arrives. If group is set, the server joins
+# that server group so that copies of it share the versions. If uses is
+# set, the server is a pipeline stage that consumes those products of
+# other servers (see Product pipelines in montolib). A persistent worker
+# gets them in the 'products' field of the header of each version, with
+# tables as JSON.
+
+
+def wrap(verslang, message, product, prodlang, runner, cache, kill, group,
+         uses):
+    asyncio.run(serve(verslang, message, product, prodlang, runner, cache,
+                      kill, group, uses))
 
-def wrap(verslang, message, product, prodlang, args, tmpfilepath):
-    montolib.server(
-        lambda c: run_command(product, message, prodlang, c, args, tmpfilepath),
-        filter=verslang
-    )
+
+async def serve(verslang, message, product, prodlang, runner, cache, kill,
+                group, uses):
+    try:
+        await montolib.async_server(
+            lambda c: run_command(product, message, prodlang, c, runner),
+            filter=verslang,
+            cache=cache,
+            cancel=kill,
+            group=group,
+            consumes=uses
+        )
+    finally:
+        await runner.close()
 
 
-def run_command(product, message, prodlang, version, args, tmpfilepath):
-    cmdstr = ' '.join(args)
+async def run_command(product, message, prodlang, version, runner):
+    cmdstr = ' '.join(runner.args)
     try:
-        with tmpfilepath.open('w') as file:
-            file.write(version['contents'])
-        tmpfilename = str(tmpfilepath)
-        stdinfd = os.open(tmpfilename, os.O_RDONLY)
-        cmdargs = make_command_args(version, args, tmpfilename)
-        output = subprocess.check_output(args=cmdargs, stdin=stdinfd)
-        os.close(stdinfd)
+        output = await runner.run(version)
         print(message)
         if message:
             wrap_product = {
@@ -92,6 +153,15 @@ def run_command(product, message, prodlang, version, args, tmpfilepath):
             'contents': err.output.decode()
         }
         return ([wrap_product], True)
+    except asyncio.TimeoutError:
+        wrap_product = {
+            'source': version['source'],
+            'product': product,
+            'language': 'text B',
+            'contents': 'Command \'{0}\' timed out after {1} seconds'.format(
+                cmdstr, runner.timeout)
+        }
+        return ([wrap_product], True)
     except Exception as err:
         wrap_product = {
             'source': version['source'],
@@ -106,9 +176,155 @@ def messages_from(text):
     x = re.split('([^:]+):([0-9]+):([0-9]+): (.*)', text)
     return str(x)
 
+# Running commands
+
+# A CommandRunner starts the command afresh for each version, at most
+# workers of them at a time. The contents of the version are written to the
+# command's standard input. They are only written to a temporary file as
+# well if an argument refers to $CONTENTS. A run that takes longer than
+# timeout seconds is killed and raises asyncio.TimeoutError.
+
+
+class CommandRunner:
+    def __init__(self, args, workers, timeout):
+        self.args = args
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(workers)
+
+    async def run(self, version):
+        data = version['contents'].encode()
+        tmpfilename = None
+        if any('$CONTENTS' in arg for arg in self.args):
+            (fd, tmpfilename) = tempfile.mkstemp(suffix='.txt')
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+        try:
+            async with self.slots:
+                cmdargs = make_command_args(version, self.args, tmpfilename)
+                process = await asyncio.create_subprocess_exec(
+                    *cmdargs, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    start_new_session=True)
+                try:
+                    (output, _) = await asyncio.wait_for(
+                        process.communicate(data), self.timeout)
+                except BaseException:
+                    await kill_process(process)
+                    raise
+        finally:
+            if tmpfilename is not None:
+                os.unlink(tmpfilename)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmdargs,
+                                                output)
+        return output
+
+    async def close(self):
+        pass
+
+# A WorkerPool keeps up to workers copies of the command running and sends
+# each version to an idle one (see Worker). The special arguments are not
+# replaced since the command is started before any versions arrive.
+
+
+class WorkerPool:
+    def __init__(self, args, workers, timeout):
+        self.args = args
+        self.timeout = timeout
+        self.workers = [Worker(args) for _ in range(workers)]
+        self.idle = asyncio.Queue()
+        for worker in self.workers:
+            self.idle.put_nowait(worker)
+
+    async def run(self, version):
+        worker = await self.idle.get()
+        try:
+            return await worker.run(version, self.timeout)
+        finally:
+            self.idle.put_nowait(worker)
+
+    async def close(self):
+        for worker in self.workers:
+            await worker.stop()
+
+# A Worker is a long-running copy of the command that processes one version
+# after another. For each version, the worker is sent a line containing a
+# JSON header with the fields of the version except 'contents' and a
+# 'length' field with the number of bytes in the contents, followed by the
+# contents as UTF-8. It replies in the same way with a JSON header line
+# that has the 'length' of its output and, optionally, a non-zero 'status'
+# if it failed, followed by the output. A worker that is killed because it
+# timed out or its run was cancelled, that exits or that breaks this
+# protocol is started again for the next version.
+
+
+class Worker:
+    def __init__(self, args):
+        self.args = args
+        self.process = None
+
+    async def run(self, version, timeout):
+        if self.process is None or self.process.returncode is not None:
+            self.process = await asyncio.create_subprocess_exec(
+                *self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                start_new_session=True)
+        try:
+            return await asyncio.wait_for(self.exchange(version), timeout)
+        except BaseException as err:
+            if not isinstance(err, subprocess.CalledProcessError):
+                await kill_process(self.process)
+            raise
+
+    async def exchange(self, version):
+        header = dict(version)
+        data = header.pop('contents').encode()
+        header['length'] = len(data)
+        if 'products' in header:
+            header['products'] = json_products(header['products'])
+        self.process.stdin.write(json.dumps(header).encode() + b'\n' + data)
+        await self.process.stdin.drain()
+        line = await self.process.stdout.readline()
+        if not line:
+            raise RuntimeError('worker exited')
+        reply = json.loads(line.decode())
+        output = await self.process.stdout.readexactly(reply['length'])
+        if reply.get('status', 0) != 0:
+            raise subprocess.CalledProcessError(reply['status'], self.args,
+                                                output)
+        return output
+
+    async def stop(self):
+        if self.process is not None:
+            await kill_process(self.process)
+
+
+# Columnar products (see Columnar products in montolib) are sent to workers
+# as JSON tables.
+
+
+def json_products(products):
+    converted = {}
+    for (name, product) in products.items():
+        if isinstance(product.get('contents'), montolib.Columns):
+            product = dict(product, contents=product['contents'].to_json())
+        converted[name] = product
+    return converted
+
+
+# Commands are started in a session of their own, so that killing one also
+# kills whatever it started, such as the programs run by a shell command.
+
+
+async def kill_process(process):
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
 
 def make_command_args(version, args, tmpfilename):
-    return map(lambda arg: replace_arg(version, arg, tmpfilename), args)
+    return [replace_arg(version, arg, tmpfilename) for arg in args]
 
 
 def replace_arg(version, arg, tmpfilename):